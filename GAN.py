@@ -9,8 +9,15 @@ from matplotlib.animation import FuncAnimation, PillowWriter
 import tqdm
 import time
 import os
-import pickle
 from models.wgan import *
+from utils.data_manager import DataManager
+from utils.normalization import standardize
+from utils.metrics import MetricsLogger, epoch_history
+from utils.validation import AsyncValidation
+from utils.checkpointing import AsyncCheckpointer
+from utils.profiling import Profiler
+from utils.distribute import make_strategy, is_chief, worker_dir, distribute_batches
+import contextlib
 #add in second inception module (done)
 #layer normalisation
 
@@ -18,8 +25,31 @@ print("Inside GAN.py", flush=True)
 
 parser = argparse.ArgumentParser(description="GAN to learn simulation cubes from initial conditions and smaller cubes")
 parser.add_argument('--index', type=int, default=0, help='An index from 0 to 20 to pick a set of learning rates and penalty strengths')
+parser.add_argument('--validate_every', type=int, default=1, help='Validation plot every n-th epoch, rendered by a background worker')
+parser.add_argument('--checkpoint_steps', type=int, default=None, help='Also checkpoint every n train steps within an epoch')
+parser.add_argument('--checkpoint_seconds', type=float, default=None, help='Also checkpoint every n seconds within an epoch')
+parser.add_argument('--sync_checkpoint', action='store_true', help='Write checkpoints in the training loop instead of in the background')
+parser.add_argument('--jit_compile', action='store_true', help='Compile the models and train steps with XLA (falls back to graph mode for unsupported ops)')
+parser.add_argument('--gp_interval', type=int, default=1, help='Lazy gradient penalty: computed every n-th critic step and scaled by n')
+parser.add_argument('--fused_scores', action='store_true', help='Score real and generated boxes in one critic call')
+parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16', 'float16'], help='Compute dtype of the models (mixed precision, variables stay float32)')
+parser.add_argument('--cache_dtype', type=str, default='float32', choices=['float32', 'float16'], help='Storage dtype of the cached cubes')
+parser.add_argument('--store', type=str, default=None, help='Read the cubes from this chunked HDF5 store (python -m utils.cube_store) instead of outputs/ and IC/')
+parser.add_argument('--redshifts', type=int, nargs='+', default=[10], help='Training redshifts, more than one trains a single redshift-conditioned model on all of them')
+parser.add_argument('--strategy', type=str, default='none', choices=['none', 'mirrored', 'multi_worker'], help='tf.distribute data parallel training, see utils/distribute.py')
+parser.add_argument('--cpu_replicas', type=int, default=1, help='Split the CPU into this many logical devices, to try --strategy mirrored without GPUs')
+parser.add_argument('--batch_size', type=int, default=4, help='Global batch size, split over the replicas')
+parser.add_argument('--profile', action='store_true', help='Time each training stage and sample memory, summarised per epoch as profile records in metrics.jsonl')
+parser.add_argument('--patch_size', type=int, default=None, help='Train on random aligned patch_size^3 sub-volumes instead of whole boxes (even, at least 32)')
+parser.add_argument('--patches', type=int, default=8, help='Patches cut from every loaded box with --patch_size')
+parser.add_argument('--critic_head', type=str, default='dense', choices=['dense', 'pool'], help="Critic output head, 'pool' (global average) scores any box or patch size")
+parser.add_argument('--trace_steps', type=int, nargs=2, default=None, metavar=('START', 'STOP'), help='Capture a tf.profiler trace of train steps START to STOP into model_path/profile (implies --profile)')
 args = parser.parse_args()
 index = args.index
+assert (args.strategy != 'multi_worker') or (args.checkpoint_seconds is None), "every worker has to take part in each save, time based checkpoints would differ between them"
+
+strategy = make_strategy(args.strategy, args.cpu_replicas) #before tensorflow runs any op
+chief = is_chief(strategy)
 
 path = os.getcwd()
 
@@ -45,200 +75,6 @@ for i,ID in enumerate(rng):
 
 """
 
-class DataManager:
-    def __init__(self, path, redshifts=[16], IC_seeds=[1000,1001]):
-        self.path = path
-        self.redshifts = redshifts
-        self.IC_seeds = IC_seeds
-
-    def get_file_lists(self):
-        assert isinstance(self.redshifts, list), "redshifts must be a list"
-        assert isinstance(self.IC_seeds, list), "IC_seeds must be a list"
-        dir_T21 = os.listdir(self.path + '/outputs')
-        T21_files = np.empty(shape=(len(self.IC_seeds), len(self.redshifts)), dtype=object)
-        for file in dir_T21:
-            if 'T21_cube' in file:
-                z = int(file.split('_')[2])
-                ID = int(file.split('_')[7])
-                if (z in self.redshifts) and (ID in self.IC_seeds):
-                    #print ID index in IC_seeds:
-                    T21_files[self.IC_seeds.index(ID), self.redshifts.index(z)] = file
-        
-        dir_IC = os.listdir(self.path + '/IC')
-        delta_files = np.empty(shape=(len(self.IC_seeds)), dtype=object)
-        vbv_files = np.empty(shape=(len(self.IC_seeds)), dtype=object)
-        for file in dir_IC:
-            if 'delta' in file:
-                ID = int(file.split('delta')[1].split('.')[0])
-                if ID in self.IC_seeds:
-                    delta_files[self.IC_seeds.index(ID)] = file
-            elif 'vbv' in file:
-                ID = int(file.split('vbv')[1].split('.')[0])
-                if ID in self.IC_seeds:
-                    vbv_files[self.IC_seeds.index(ID)] = file
-        
-        return T21_files, delta_files, vbv_files
-    
-    def generator_func(self, augment=False, augments=24, low_res=False):
-        assert len(self.redshifts) == 1, "generator_func only works for one redshift at a time"
-        T21_files, delta_files, vbv_files = self.get_file_lists()
-        #print(T21_files,augments)
-        if augment:
-            augs = np.array([np.random.choice(24, size=augments, replace=False) for i in range(len(delta_files))]) #might need shuffling 
-            #print(augs)
-            #k=0
-            for i in range(augments):
-                #print("test: ", augs[:,i])
-                #print("test2: ", T21_files[0],delta_files,vbv_files,augs[:,i])
-                for j,(T21_file, delta_file, vbv_file, aug) in enumerate(zip(T21_files,delta_files,vbv_files,augs[:,i])):
-                    #k+=1
-                    #print(T21_file[0].split('_')[7], delta_file.split("delta")[1].split(".")[0], vbv_file.split("vbv")[1].split(".")[0], aug)
-                    #print("j={0}, k={1}".format(j,k))
-                    T21 = loadmat(self.path + '/outputs/' + T21_file[0])['Tlin']
-                    delta = loadmat(self.path + '/IC/' + delta_file)['delta']
-                    vbv = loadmat(self.path + '/IC/' + vbv_file)['vbv']
-
-                    T21 = self.augment_data(T21, augments=aug).reshape(1,128,128,128,1)
-                    delta = self.augment_data(delta, augments=aug).reshape(1,128,128,128,1)
-                    vbv = self.augment_data(vbv, augments=aug).reshape(1,128,128,128,1)
-                    if low_res:
-                        T21_lr = tf.keras.layers.GaussianNoise(tf.reduce_mean(T21)*0.05)(T21)
-                        T21_lr = tf.keras.layers.Conv3D(filters=1, kernel_size=(2, 2, 2),
-                                                                       kernel_initializer=tf.keras.initializers.constant(value=1/8),
-                                                                       use_bias=False, bias_initializer=None, #tf.keras.initializers.Constant(value=0.1),
-                                                                       strides=(2, 2, 2), padding='valid', data_format="channels_last", 
-                                                                       activation=None,
-                                                                       )(T21_lr)                        
-                    else:
-                        T21_lr = T21[:,:64,:64,:64,:]
-                    
-                    
-                    T21 = tf.cast(tf.reshape(T21, (128,128,128,1)), dtype=tf.float32)
-                    delta = tf.cast(tf.reshape(delta, (128,128,128,1)), dtype=tf.float32)
-                    vbv = tf.cast(tf.reshape(vbv, (128,128,128,1)), dtype=tf.float32)
-                    T21_lr = tf.cast(tf.reshape(T21_lr, (64,64,64,1)), dtype=tf.float32)
-                    yield T21, delta, vbv, T21_lr
-        else:
-            for j,(T21_file, delta_file, vbv_file) in enumerate(zip(T21_files,delta_files,vbv_files)):
-                T21 = loadmat(self.path + '/outputs/' + T21_file[0])['Tlin']
-                delta = loadmat(self.path + '/IC/' + delta_file)['delta']
-                vbv = loadmat(self.path + '/IC/' + vbv_file)['vbv']
-                T21_lr = T21[:64,:64,:64]
-                
-                T21_lr = tf.cast(tf.reshape(T21_lr, (64,64,64,1)), dtype=tf.float32)
-                T21 = tf.cast(tf.reshape(T21, (128,128,128,1)), dtype=tf.float32)
-                delta = tf.cast(tf.reshape(delta, (128,128,128,1)), dtype=tf.float32)
-                vbv = tf.cast(tf.reshape(vbv, (128,128,128,1)), dtype=tf.float32)
-                print(j, T21.shape, delta.shape, vbv.shape, T21_lr.shape)
-                yield T21, delta, vbv, T21_lr
-            
-    
-        
-
-
-    def load(self):
-        T21_files, delta_files, vbv_files = self.get_file_lists()
-        T21 = np.zeros((len(self.IC_seeds), 128, 128, 128, len(self.redshifts)), dtype=np.float32)
-        delta = np.zeros((len(self.IC_seeds), 128, 128, 128), dtype=np.float32)
-        vbv = np.zeros((len(self.IC_seeds), 128, 128, 128), dtype=np.float32)
-        for i,file in enumerate(T21_files):
-            delta[i] = loadmat(self.path + '/IC/' + delta_files[i])['delta']
-            vbv[i] = loadmat(self.path + '/IC/' + vbv_files[i])['vbv']
-            for j,file_ in enumerate(file):
-                T21[i,:,:,:,j] = loadmat(self.path + '/outputs/' + file_)['Tlin']
-        return T21, delta, vbv
-    
-    def data(self, augment=False, augments=23, low_res=False):
-        #augments: number of augmented data per IC seed. Always includes the unaltered box
-        T21, delta, vbv = self.load()
-        if augment:
-            assert (augments <= 23) and (augments>=1), "augments must be between 1 and 23"
-            delta_augmented = np.empty(((augments+1)*len(self.IC_seeds), 128, 128, 128), dtype=np.float32)
-            vbv_augmented = np.empty(((augments+1)*len(self.IC_seeds), 128, 128, 128), dtype=np.float32)
-            T21_augmented = np.empty(((augments+1)*len(self.IC_seeds), 128, 128, 128, len(self.redshifts)), dtype=np.float32)
-
-            for i in range(len(self.IC_seeds)):
-                augs = [*np.random.choice(23, size=augments, replace=True), 23]
-                delta_augmented[i*(augments+1):(i+1)*(augments+1)] = self.augment_data(delta[i], augments=augs)
-                vbv_augmented[i*(augments+1):(i+1)*(augments+1)] = self.augment_data(vbv[i], augments=augs)
-                for j in range(len(self.redshifts)):
-                    T21_augmented[i*(augments+1):(i+1)*(augments+1),:,:,:,j] = self.augment_data(T21[i,:,:,:,j], augments=augs)
-            T21 = tf.cast(T21_augmented, dtype=tf.float32)
-            delta = tf.expand_dims(input=tf.cast(delta_augmented, dtype=tf.float32), axis=4)
-            vbv = tf.expand_dims(input=tf.cast(vbv_augmented, dtype=tf.float32), axis=4)
-        else:
-            T21 = tf.cast(T21, dtype=tf.float32)
-            delta = tf.expand_dims(input=tf.cast(delta, dtype=tf.float32), axis=4)
-            vbv = tf.expand_dims(input=tf.cast(vbv, dtype=tf.float32), axis=4)
-
-        if low_res:
-            T21_lr = np.empty((T21.shape[0], 64, 64, 64, T21.shape[-1]), dtype=np.float32)
-            for i in range(T21.shape[0]):
-                for j in range(T21.shape[-1]):
-                    temp = tf.reshape(T21[i,:,:,:,j], (1,128,128,128,1))
-                    #add 5% gaussian noise
-                    #temp = tf.keras.layers.GaussianNoise(tf.reduce_mean(temp)*0.1)(temp)
-                    #T21_lr[i,:,:,:,j] = tf.keras.layers.Conv3D(filters=1, kernel_size=(2, 2, 2),
-                    #                                           kernel_initializer=tf.keras.initializers.constant(value=1/8),#GaussianKernelInitializer(stddev=0.5, size=2)
-                    #                                           use_bias=False, bias_initializer=None, #tf.keras.initializers.Constant(value=0.1),
-                    #                                           strides=(2, 2, 2), padding='valid', data_format="channels_last", 
-                    #                                           activation=None,
-                    #                                           )(temp).numpy().reshape(64,64,64)
-                    #try average pooling 
-                    #T21_lr[i,:,:,:,j] = tf.keras.layers.AveragePooling3D(pool_size=(2, 2, 2), strides=(2, 2, 2), padding='valid', data_format="channels_last")(temp).numpy().reshape(64,64,64)  
-                    T21_lr[i,:,:,:,j] = temp[0,::2,::2,::2,0].numpy()
-                    
-                    #fig,axes = plt.subplots(1,1,figsize=(10,5))
-                    #axes[0].imshow(T21[i,:,:,64,j])
-                    #axes[1].imshow(T21_lr[i,:,:,32,j])
-                    #histograms instead
-                    #axes.hist(T21[i,:,:,:,j].numpy().flatten(), density=True, bins=100, alpha=0.5, label="real")
-                    #axes.hist(T21_lr[i,:,:,:,j].flatten(), density=True, bins=100, alpha=0.5, label="fake")
-                    #axes.legend()
-                    #plt.show()
-                    
-            T21_lr = tf.cast(T21_lr, dtype=tf.float32)
-        else:
-            T21_lr = None
-        return T21, delta, vbv, T21_lr
-
-    def augment_data(self, x, augments=23):
-        y = np.empty((24,*x.shape))
-
-        y[0,:,:,:] = x[::-1, ::-1, :]
-        y[1,:,:,:] = x[::-1, :, ::-1]
-        y[2,:,:,:] = x[:, ::-1, ::-1]
-        
-        y[3,:,:,:] = tf.transpose(x, (1, 0, 2))[::-1, :, :]
-        y[4,:,:,:] = tf.transpose(x, (1, 0, 2))[::-1, :, ::-1]
-        y[5,:,:,:] = tf.transpose(x, (1, 0, 2))[:, ::-1, :]
-        y[6,:,:,:] = tf.transpose(x, (1, 0, 2))[:, ::-1, ::-1]
-
-        y[7,:,:,:] = tf.transpose(x, (2, 1, 0))[::-1, :, :]
-        y[8,:,:,:] = tf.transpose(x, (2, 1, 0))[::-1, ::-1, :]
-        y[9,:,:,:] = tf.transpose(x, (2, 1, 0))[:, :, ::-1]
-        y[10,:,:,:] = tf.transpose(x, (2, 1, 0))[:, ::-1, ::-1]
-
-        y[11,:,:,:] = tf.transpose(x, (0, 2, 1))[:, ::-1, :]
-        y[12,:,:,:] = tf.transpose(x, (0, 2, 1))[::-1, ::-1, :]
-        y[13,:,:,:] = tf.transpose(x, (0, 2, 1))[:, :, ::-1]
-        y[14,:,:,:] = tf.transpose(x, (0, 2, 1))[::-1, :, ::-1]
-
-        y[15,:,:,:] = tf.transpose(x, (1, 2, 0))[::-1, ::-1, :]
-        y[16,:,:,:] = tf.transpose(x, (1, 2, 0))[:, ::-1, ::-1]
-        y[17,:,:,:] = tf.transpose(x, (1, 2, 0))[::-1, :, ::-1]
-        y[18,:,:,:] = tf.transpose(x, (1, 2, 0))[::-1, ::-1, ::-1]
-        
-        y[19,:,:,:] = tf.transpose(x, (2, 0, 1))[::-1, ::-1, :]
-        y[20,:,:,:] = tf.transpose(x, (2, 0, 1))[::-1, :, ::-1]
-        y[21,:,:,:] = tf.transpose(x, (2, 0, 1))[:, ::-1, ::-1]
-        y[22,:,:,:] = tf.transpose(x, (2, 0, 1))[::-1, ::-1, ::-1]
-        y[23,:,:,:] = x
-        
-        return y[augments,:,:,:]
-
-
-
 Data = DataManager(path, redshifts=list(np.arange(6,28,1)), IC_seeds=list(range(1000,1002)))
 
 dataset = tf.data.Dataset.from_generator(Data.generator_func,
@@ -252,83 +88,6 @@ dataset = tf.data.Dataset.from_generator(Data.generator_func,
 
 
 
-def standardize(data, data_stats):
-    mean, var = tf.nn.moments(data_stats, axes=[1,2,3], keepdims=True) #mean across xyz with shape=(batch,x,y,z,channels)
-    mean = mean.numpy()
-    var = var.numpy()
-    for i,(m,v) in enumerate(zip(mean,var)):
-        if m==0 and v==0:
-            mean[i] = 0
-            var[i] = 1
-            #print("mean and var both zero for i={0} j={1}, setting mean to {2} and var to {3}".format(i,np.nan,mean[i],var[i]))
-    std = var**0.5
-    return (data - mean) / std
-
-def plot_and_save(IC_seeds, redshift, sigmas, plot_slice=True):
-    fig = plt.figure(tight_layout=True, figsize=(20,10))
-    gs = gridspec.GridSpec(len(IC_seeds)+1, 6, figure=fig)
-    ax_loss = fig.add_subplot(gs[0,:])
-
-    #loss row
-    ax_loss.plot(range(len(generator_losses_epoch)), generator_losses_epoch, label="generator")
-    ax_loss.plot(range(len(critic_losses_epoch)), critic_losses_epoch, label="critic")
-    ax_loss.plot(range(len(gradient_penalty_epoch)), gradient_penalty_epoch, label="gradient penalty")
-    ax_loss.set_title("lambda={0}, learning rate={1}".format(lbda, learning_rate))
-    ax_loss.set_xlabel("Epoch")
-    ax_loss.set_ylabel("Loss")
-    ax_loss.legend()
-
-    # Validation data
-    Data_validation = DataManager(path, redshifts=[redshift,], IC_seeds=IC_seeds)
-    T21, delta, vbv, T21_lr = Data_validation.data(augment=False, augments=9, low_res=True) 
-    T21_standardized = standardize(T21, T21_lr)
-    T21_lr_standardized = standardize(T21_lr, T21_lr)
-    vbv_standardized = standardize(vbv, vbv)
-    generated_boxes = generator(T21_lr_standardized, delta, vbv_standardized).numpy()
-
-    for i,IC in enumerate(IC_seeds):
-        # Plot histograms
-        ax_hist = fig.add_subplot(gs[i+1,0])
-        ax_hist.hist(generated_boxes[i, :, :, :, 0].flatten(), bins=100, alpha=0.5, label="generated", density=True)
-        ax_hist.hist(T21_standardized[i, :, :, :, 0].numpy().flatten(), bins=100, alpha=0.5, label="real", density=True)
-        ax_hist.set_xlabel("Standardized T21")
-        ax_hist.set_title("Histograms of standardized data")
-        ax_hist.legend()
-
-        # Plot real and generated data
-        T21_std = np.std(T21_standardized[i, :, :, :, 0].numpy().flatten())
-        ax_gen = fig.add_subplot(gs[i+1,1])
-        ax_gen.imshow(generated_boxes[i, :, :, 64, 0], vmin=-sigmas*T21_std, vmax=sigmas*T21_std)
-        ax_gen.set_title("Generated")
-        ax_real = fig.add_subplot(gs[i+1,2])
-        ax_real.imshow(T21_standardized[i, :, :, 64, 0], vmin=-sigmas*T21_std, vmax=sigmas*T21_std)
-        ax_real.set_title("Real")
-        ax_real_lr = fig.add_subplot(gs[i+1,3])
-        ax_real_lr.imshow(T21_lr_standardized[i, :, :, 32, 0], vmin=-sigmas*T21_std, vmax=sigmas*T21_std)
-        ax_real_lr.set_title("Real lr")
-
-        if plot_slice:
-            ax_delta = fig.add_subplot(gs[i+1,4])
-            delta_std = np.std(delta[i, :, :, :, 0].numpy().flatten())
-            ax_delta.imshow(delta[i, :, :, 64, 0], vmin=-sigmas*delta_std, vmax=sigmas*delta_std)
-            ax_delta.set_title("Delta IC ID={0}".format(IC))
-            ax_vbv = fig.add_subplot(gs[i+1,5])
-            vbv_std = np.std(vbv_standardized[i, :, :, :, 0].numpy().flatten())
-            ax_vbv.imshow(vbv_standardized[i, :, :, 64, 0], vmin=-sigmas*vbv_std, vmax=sigmas*vbv_std)
-            ax_vbv.set_title("Vbv IC ID={0}".format(IC))
-        else: #histogram delta and vbv_standardised
-            ax_delta = fig.add_subplot(gs[i+1,4])
-            ax_delta.hist(delta[i, :, :, :, 0].numpy().flatten(), bins=100, alpha=0.5, label="delta", density=True)
-            ax_delta.set_title("Histogram delta IC ID={0}".format(IC))
-            ax_delta.legend()
-            ax_vbv = fig.add_subplot(gs[i+1,5])
-            ax_vbv.hist(vbv_standardized[i, :, :, :, 0].numpy().flatten(), bins=100, alpha=0.5, label="vbv", density=True)
-            ax_vbv.set_title("Histogram vbv IC ID={0}".format(IC))
-            ax_vbv.legend()
-
-    # Save figure
-    plt.savefig(model_path+"/loss_history_and_validation_lambda_{0}_lr_{1}.png".format(lbda, learning_rate))
-
 ##check T21_lr
 #load data
 Data = DataManager(path, redshifts=[10,], IC_seeds=list(range(1000,1010)))
@@ -350,14 +109,30 @@ lbda,learning_rate = combinations[index]
 
 print("Params: ", lbda, learning_rate, flush=True)
 
+#several redshifts: (seed, redshift, orientation) samples streamed from the per redshift cache files, with the redshift as an extra vbv channel
+redshift_conditioning = len(args.redshifts) > 1
 
-generator = Generator()
-critic = Critic(lbda=lbda)
+set_precision(args.precision) #before the models are built
 
+#variables (models, optimizer state and metrics) are mirrored on every replica when they are created under the strategy
+#the models are fully convolutional, a generator trained on patches has the same weights as one for whole boxes
+box = 128 if args.patch_size is None else args.patch_size
+assert box % 2 == 0, "patch_size must be even, the low-res T21 is half the box"
+with (strategy.scope() if strategy is not None else contextlib.nullcontext()):
+    generator = Generator(T21_shape=(1,box//2,box//2,box//2,1), delta_shape=(1,box,box,box,1), vbv_shape=(1,box,box,box,1+redshift_conditioning), jit_compile=args.jit_compile)
+    critic = Critic(lbda=lbda, jit_compile=args.jit_compile, gp_interval=args.gp_interval, fused_scores=args.fused_scores, head=args.critic_head)
+    #the critic scores the generator output, which is 2*generator.crop cells smaller than the box
+    min_box = critic.min_input_size() + 2*generator.crop
+    assert box >= min_box, "patch_size must be at least {0} (the critic needs {1} cells, the generator crops {2})".format(min_box + min_box % 2, critic.min_input_size(), 2*generator.crop)
 
 
-generator_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2)
-critic_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2)
+
+    generator_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2)
+    critic_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2)
+    if args.precision == 'float16': #dynamic loss scaling, bfloat16 has the exponent range of float32 and doesn't need it
+        generator_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(generator_optimizer)
+        critic_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(critic_optimizer)
+    trainer = WGANTrainer(generator, critic, generator_optimizer, critic_optimizer, n_critic=n_critic, jit_compile=args.jit_compile, strategy=strategy)
 
 #model.summary()
 #tf.keras.utils.plot_model(model, to_file=path+'/generator_model.png', show_shapes=True, show_layer_names=True, show_layer_activations=True)
@@ -388,7 +163,7 @@ critic_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=
 
 
 
-Data = DataManager(path, redshifts=[10,], IC_seeds=list(range(1000,1008)))
+Data = DataManager(path, redshifts=args.redshifts, IC_seeds=list(range(1000,1008)), cache_dtype=args.cache_dtype, store=args.store)
 #dataset = tf.data.Dataset.from_generator(Data.generator_func,
 #                                         args=(True, 2, True),
 #                                         output_signature=(
@@ -397,12 +172,19 @@ Data = DataManager(path, redshifts=[10,], IC_seeds=list(range(1000,1008)))
 #                                             tf.TensorSpec(shape=(128,128,128,1), dtype=tf.float32),
 #                                             tf.TensorSpec(shape=(64,64,64,1), dtype=tf.float32)
 #                                             ))
-dataset = Data.data(augment=True, augments=9, low_res=True)
-dataset = tf.data.Dataset.from_tensor_slices(dataset)
-
-batches = dataset.batch(4)
-
-print("Number of batches: ", len(list(batches)), flush=True)
+#dataset = Data.data(augment=True, augments=9, low_res=True)
+#dataset = tf.data.Dataset.from_tensor_slices(dataset)
+dataset = lambda shards=1, shard_index=0: Data.dataset(augments=10, low_res=True, workers=max(os.cpu_count()-1, 1), standardize=True,
+                                                       per_redshift=redshift_conditioning, condition=redshift_conditioning,
+                                                       shards=shards, shard_index=shard_index, patch_size=args.patch_size, patches=args.patches) #lazy: 9 random orientations + the unaltered box per seed, oriented on the fly
+
+if strategy is None:
+    batches = dataset().batch(args.batch_size).prefetch(tf.data.AUTOTUNE) #decoding and augmentation of the next batches overlaps the train steps
+    print("Number of batches: ", len(batches), flush=True)
+else:
+    #every worker loads its own shard of the samples, each replica gets batches of batch_size/replicas
+    batches = distribute_batches(strategy, dataset, args.batch_size)
+    print("Replicas: {0}, global batch size: {1}".format(strategy.num_replicas_in_sync, args.batch_size), flush=True)
 
 
 
@@ -410,90 +192,117 @@ print("Number of batches: ", len(list(batches)), flush=True)
 
 
 model_path = path+"/trained_models/model_{0}".format(31)#index+20)#22
+model_path = worker_dir(model_path, strategy) #workers other than the chief write (and resume from) their own copy
 #make model directory if it doesn't exist:
 if os.path.exists(model_path)==False:
-    os.mkdir(model_path)
+    os.makedirs(model_path)
+epochs_done = tf.Variable(0, dtype=tf.int64, trainable=False) #completed epochs, the epoch to resume from
 ckpt = tf.train.Checkpoint(generator_model=generator.model, critic_model=critic.model, 
                            generator_optimizer=generator_optimizer, critic_optimizer=critic_optimizer,
+                           epochs_done=epochs_done,
                            )
 manager = tf.train.CheckpointManager(ckpt, model_path+"/checkpoints", max_to_keep=5)
+#saved at the end of every epoch and, if set, every checkpoint_steps/checkpoint_seconds, written in the background
+checkpointer = AsyncCheckpointer(manager, every_steps=args.checkpoint_steps, every_seconds=args.checkpoint_seconds,
+                                 async_save=not (args.sync_checkpoint or args.strategy == 'multi_worker')) #multi worker saves are collective, written synchronously
 
 resume = False
 
 if resume:
     weights_before = generator.model.get_weights()
-    ckpt.restore(manager.latest_checkpoint)
+    print("Restored ", checkpointer.restore(), flush=True) #newest complete checkpoint
     weights_after = generator.model.get_weights()
     are_weights_different = any([not np.array_equal(w1, w2) for w1, w2 in zip(weights_before, weights_after)])
     print("Are weights different after restoring from checkpoint: ", are_weights_different, flush=True)
 
-    if (os.path.exists(model_path+"/losses.pkl")==False) or (os.path.exists(model_path+"/checkpoints")==False) or (are_weights_different==False):
-        assert False, "Resume=True: Checkpoints directory or losses file does not exist or weights are unchanged after restoring, cannot resume training."
+    if (os.path.exists(model_path+"/metrics.jsonl")==False) or (os.path.exists(model_path+"/checkpoints")==False) or (are_weights_different==False):
+        assert False, "Resume=True: Checkpoints directory or metrics file does not exist or weights are unchanged after restoring, cannot resume training."
 else:
     print("Initializing from scratch.", flush=True)
-    if os.path.exists(model_path+"/losses.pkl") or os.path.exists(model_path+"/checkpoints"):
-        assert False, "Resume=False: Loss file or checkpoints directory already exists, exiting..."
-    print("Creating loss file...", flush=True)
-    with open(model_path+"/losses.pkl", "wb") as f:
-        generator_losses_epoch = []
-        critic_losses_epoch = []
-        gradient_penalty_epoch = []
-        pickle.dump((generator_losses_epoch, critic_losses_epoch, gradient_penalty_epoch), f)
+    if os.path.exists(model_path+"/metrics.jsonl") or os.path.exists(model_path+"/checkpoints"):
+        assert False, "Resume=False: Metrics file or checkpoints directory already exists, exiting..."
 
+#per batch and per epoch losses and timings, appended by a background thread. On resume the history is cut to the
+#epochs in the checkpoint, the epochs after it are trained (and logged) again
+metrics = MetricsLogger(model_path+"/metrics.jsonl")
+start_epoch = int(epochs_done.numpy())
+generator_losses_epoch, critic_losses_epoch, gradient_penalty_epoch = [losses[:start_epoch] for losses in epoch_history(model_path+"/metrics.jsonl")]
 
+#validation cubes are loaded once by a background worker process, which plots a snapshot of the generator weights. Only on the chief
+validation = None if not chief else AsyncValidation(model_path, path, IC_seeds=[1008,1009,1010], redshift=10,
+                             figure=model_path+"/loss_history_and_validation_lambda_{0}_lr_{1}.png".format(lbda, learning_rate),
+                             title="lambda={0}, learning rate={1}".format(lbda, learning_rate), sigmas=3, plot_slice=False, every=args.validate_every,
+                             redshift_conditioning=redshift_conditioning, store=args.store)
+
+#stage timers and memory samples, no-ops unless --profile or --trace_steps is given
+profiler = Profiler(enabled=args.profile or (args.trace_steps is not None), trace_dir=model_path+"/profile", trace_steps=args.trace_steps)
 
 print("Starting training...", flush=True)
-for e in range(epochs):
+for e in range(start_epoch, epochs):
     start = time.time()
 
-    generator_losses = []
-    critic_losses = []
-    gradient_penalty = []
-    for i, (T21, delta, vbv, T21_lr) in enumerate(batches):
-        #print("shape inputs: ", T21.shape, delta.shape, vbv.shape, T21_lr.shape)
+    trainer.reset_metrics()
+    iterator = iter(batches) #batches are standardised in the dataset
+    i = 0
+    while True:
         start_start = time.time()
-        T21_standardized = standardize(T21, T21_lr)
-        T21_lr_standardized = standardize(T21_lr, T21_lr)
-        vbv_standardized = standardize(vbv, vbv)
-        
-        crit_loss, gp = critic.train_step_critic(T21_standardized, delta, vbv_standardized, T21_lr_standardized, critic_optimizer, generator)
-        critic_losses.append(crit_loss)
-        gradient_penalty.append(gp)
-
-        if i%n_critic == 0:
-            gen_loss = generator.train_step_generator(T21_lr_standardized, T21_standardized, delta, vbv_standardized, generator_optimizer, critic)
-            generator_losses.append(gen_loss)
-        
-        print("Time for batch {0} is {1:.2f} sec".format(i + 1, time.time() - start_start), flush=True)
+        #n_critic critic steps and one generator step in one compiled call, or stage by stage while profiling
+        if profiler.enabled:
+            steps, critic_losses, gradient_penalties, generator_loss = trainer.stepwise_cycle(iterator, profiler)
+        else:
+            steps, critic_losses, gradient_penalties, generator_loss = trainer.train_cycle(iterator)
+        steps, critic_losses, gradient_penalties, generator_loss = int(steps), critic_losses.numpy(), gradient_penalties.numpy(), generator_loss.numpy()
+        cycle_time = time.time() - start_start
+        if steps > 0:
+            print("Time for batches {0}-{1} is {2:.2f} sec".format(i + 1, i + steps, cycle_time), flush=True)
+        for k in range(steps):
+            batch_losses = dict(generator_loss=generator_loss) if k == 0 else {} #one generator step per cycle, on its first batch
+            metrics.log('batch', epoch=e, batch=i+k, critic_loss=critic_losses[k], gradient_penalty=gradient_penalties[k], batch_time=cycle_time/steps, **batch_losses)
+        i += steps
+        with profiler.timer('checkpoint'):
+            checkpointer.save(int(critic_optimizer.iterations)) #one critic step per batch, only saves if checkpoint_steps or checkpoint_seconds are due
+        if steps < n_critic:
+            break
+    generator_losses = trainer.generator_loss_metric.result().numpy()
+    critic_losses = trainer.critic_loss_metric.result().numpy()
+    gradient_penalty = trainer.gradient_penalty_metric.result().numpy()
     
     #save losses
-    with open(model_path+"/losses.pkl", "rb") as f: # Open the file in read mode and get data
-        generator_losses_epoch, critic_losses_epoch, gradient_penalty_epoch = pickle.load(f)
-    # Append the new values to the existing data
     generator_losses_epoch.append(np.mean(generator_losses))
     critic_losses_epoch.append(np.mean(critic_losses))
     gradient_penalty_epoch.append(np.mean(gradient_penalty))
-    with open(model_path+"/losses.pkl", "wb") as f: # Open the file in write mode and dump the data
-        pickle.dump((generator_losses_epoch, critic_losses_epoch, gradient_penalty_epoch), f)
+    metrics.log('epoch', epoch=e, generator_loss=generator_losses_epoch[-1], critic_loss=critic_losses_epoch[-1], gradient_penalty=gradient_penalty_epoch[-1], batches=i, train_time=time.time()-start)
     
     #checkpoint
     #if e%2 == 0:
+    epochs_done.assign(e + 1)
     print("Saving checkpoint...", flush=True)
-    manager.save()
-    print("Checkpoint saved!", flush=True)
+    with profiler.timer('checkpoint'):
+        checkpoint_path = checkpointer.save(int(critic_optimizer.iterations), force=True)
+    print("Checkpoint {0} is being written in the background".format(checkpoint_path) if checkpointer.async_save else "Checkpoint saved!", flush=True)
 
     #"validation: plot and savefig loss history, and histograms and imshows for two models for every 10th epoch"
     #with gridspec loss history should extend the whole top row and the histograms and imshows should fill one axes[i,j] for the bottom rows
-    if e%1 == 0:
-        plot_and_save(IC_seeds=[1008,1009,1010], redshift=10, sigmas=3, plot_slice=False)
+    with profiler.timer('metrics_flush'):
+        metrics.flush() #the worker reads the loss history from the metrics file
+    with profiler.timer('validation_submit'):
+        if validation is not None:
+            validation.submit(e, generator)
+    if profiler.enabled:
+        metrics.log('profile', epoch=e, **profiler.summary())
 
     print("Time for epoch {0} is {1:.2f} sec \nGenerator mean loss: {2:.2f}, \nCritic mean loss: {3:.2f}, \nGradient mean penalty: {4:.2f}".format(e + 1, time.time() - start, np.mean(generator_losses), np.mean(critic_losses), np.mean(gradient_penalty)), flush=True)
+    log_trace_counts() #should stay at 1 per function, a growing count means a retrace
     #break
 
 
 
-with open(model_path+"/losses.pkl", "rb") as f:
-    generator_losses_epoch, critic_losses_epoch, gradient_penalty_epoch = pickle.load(f)
+profiler.close()
+metrics.close()
+if validation is not None:
+    validation.close()
+checkpointer.sync()
+generator_losses_epoch, critic_losses_epoch, gradient_penalty_epoch = epoch_history(model_path+"/metrics.jsonl")
 #print last 10 losses and total number of epochs
 print("Last 10 losses: \nGenerator: {0} \nCritic: {1} \nGradient penalty: {2}".format(generator_losses_epoch[-10:], critic_losses_epoch[-10:], gradient_penalty_epoch[-10:]))
 
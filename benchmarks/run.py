@@ -0,0 +1,160 @@
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import queue
+import resource
+import tempfile
+import time
+import numpy as np
+
+#Throughput and peak memory of the model steps and the data pipeline on synthetic cubes, written as JSON:
+#python -m benchmarks.run --box_sizes 32 64 --batch_sizes 1 2 --output benchmarks/results.json
+#Every configuration runs in its own (spawned) process, so peak_rss_mb is the peak of that configuration alone
+#and tensorflow state (traces, allocator caches) doesn't carry over between configurations
+
+
+def peak_memory():
+    #peak resident set size of this process in MB (ru_maxrss is in kB on linux) and, on a GPU, the allocator peak
+    memory = {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    import tensorflow as tf
+    if tf.config.list_physical_devices('GPU'):
+        memory['peak_gpu_mb'] = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20
+    return memory
+
+
+def timeit(fn, repeats, warmup=1):
+    #seconds per call of fn, fn must block until its result is ready (e.g. call .numpy())
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summary(name, times, samples, **config):
+    return dict(benchmark=name, **config, mean_s=float(np.mean(times)), std_s=float(np.std(times)),
+                min_s=float(np.min(times)), samples_per_s=samples/float(np.mean(times)))
+
+
+def model_benchmark(box_size, batch_size, repeats, jit_compile=False, fused_inception=True, gp_interval=1, fused_scores=False, precision='float32', critic_head='dense'):
+    #Generator.call forward, train_step_generator and train_step_critic (with the gradient penalty) of WGANTrainer.
+    #With gp_interval > 1 the train_step_critic time is the average over steps with and without the penalty
+    import tensorflow as tf
+    from models.wgan import Generator, Critic, WGANTrainer, set_precision
+    from benchmarks.synthetic import synthetic_batch
+
+    config = dict(box_size=box_size, batch_size=batch_size, jit_compile=jit_compile, fused_inception=fused_inception,
+                  gp_interval=gp_interval, fused_scores=fused_scores, precision=precision, critic_head=critic_head)
+    set_precision(precision)
+    optimizers = [tf.keras.optimizers.Adam(1e-4), tf.keras.optimizers.Adam(1e-4)]
+    if precision == 'float16':
+        optimizers = [tf.keras.mixed_precision.LossScaleOptimizer(o) for o in optimizers]
+    generator = Generator(T21_shape=(1, box_size//2, box_size//2, box_size//2, 1), delta_shape=(1, box_size, box_size, box_size, 1),
+                          vbv_shape=(1, box_size, box_size, box_size, 1), jit_compile=jit_compile, fused_inception=fused_inception)
+    critic = Critic(jit_compile=jit_compile, gp_interval=gp_interval, fused_scores=fused_scores, head=critic_head)
+    trainer = WGANTrainer(generator, critic, *optimizers, jit_compile=jit_compile)
+    T21_big, IC_delta, IC_vbv, T21_small = [tf.constant(x) for x in synthetic_batch(box_size, batch_size)]
+
+    results = [summary('generator_forward', timeit(lambda: generator(T21_small, IC_delta, IC_vbv).numpy(), repeats), batch_size, **config),
+               summary('train_step_generator', timeit(lambda: trainer.train_step_generator(T21_big, IC_delta, IC_vbv, T21_small).numpy(), repeats), batch_size, **config),
+               summary('train_step_critic', timeit(lambda: [x.numpy() for x in trainer.train_step_critic(T21_big, IC_delta, IC_vbv, T21_small)], repeats), batch_size, **config),
+               ]
+    memory = peak_memory()
+    return [dict(r, **memory) for r in results]
+
+
+def data_benchmark(box_size, batch_size, repeats, workers=0, augments=4, n_seeds=4):
+    #samples/s of DataManager.dataset (orientation, low-res and standardisation included), after the cache is built
+    import tensorflow as tf
+    from utils.data_manager import DataManager
+    from benchmarks.synthetic import write_synthetic_data
+
+    config = dict(box_size=box_size, batch_size=batch_size, workers=workers, augments=augments)
+    with tempfile.TemporaryDirectory() as path:
+        IC_seeds = list(range(1000, 1000 + n_seeds))
+        write_synthetic_data(path, box_size=box_size, IC_seeds=IC_seeds, redshifts=(10,))
+        Data = DataManager(path, redshifts=[10], IC_seeds=IC_seeds)
+        start = time.perf_counter()
+        Data.build_cache()
+        cache_time = time.perf_counter() - start
+
+        dataset = Data.dataset(augments=augments, low_res=True, workers=workers, standardize=True).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+        samples = n_seeds * augments
+        def epoch():
+            for batch in dataset:
+                batch[0].numpy()
+        results = [summary('dataset_epoch', timeit(epoch, repeats), samples, **config),
+                   dict(benchmark='build_cache', **config, mean_s=cache_time, samples_per_s=n_seeds/cache_time)]
+        if workers > 0:
+            Data.loader.close()
+    memory = peak_memory()
+    return [dict(r, **memory) for r in results]
+
+
+def isolated(results, fn, args, kwargs):
+    results.put(fn(*args, **kwargs))
+
+
+def run_isolated(fn, *args, **kwargs):
+    #a plain Process rather than a Pool: pool workers are daemons and the data benchmark starts its own worker processes
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=isolated, args=(results, fn, args, kwargs))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            assert process.is_alive() or not results.empty(), "{0} exited with code {1}".format(fn.__name__, process.exitcode)
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Model step and data pipeline benchmarks on synthetic cubes")
+    parser.add_argument('--box_sizes', type=int, nargs='+', default=[32, 64], help='High-res box sizes (the low-res input is half)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2], help='Data loader worker processes to compare')
+    parser.add_argument('--jit_compile', action='store_true', help='Also benchmark the models compiled with XLA')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['float32'], help='Model compute dtypes to compare (float32, bfloat16, float16)')
+    parser.add_argument('--gp_intervals', type=int, nargs='+', default=[1], help='Lazy gradient penalty intervals to compare')
+    parser.add_argument('--fused_scores', action='store_true', help='Also benchmark the critic with real and generated boxes scored in one call')
+    parser.add_argument('--critic_heads', type=str, nargs='+', default=['dense'], help="Critic output heads to compare (dense, pool)")
+    parser.add_argument('--skip_models', action='store_true')
+    parser.add_argument('--skip_data', action='store_true')
+    parser.add_argument('--output', type=str, default='benchmarks/results.json')
+    args = parser.parse_args()
+
+    import tensorflow as tf
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'tensorflow': tf.__version__, 'python': platform.python_version(),
+              'machine': platform.machine(), 'cpu_count': os.cpu_count(),
+              'devices': [d.name for d in tf.config.list_physical_devices()], 'results': []}
+
+    for box_size in args.box_sizes:
+        for batch_size in args.batch_sizes:
+            n = len(report['results'])
+            if not args.skip_models:
+                for jit_compile, gp_interval, fused_scores, precision, critic_head in itertools.product([False, True] if args.jit_compile else [False], args.gp_intervals,
+                                                                                                        [False, True] if args.fused_scores else [False], args.precisions, args.critic_heads):
+                    report['results'] += run_isolated(model_benchmark, box_size, batch_size, args.repeats, jit_compile=jit_compile,
+                                                      gp_interval=gp_interval, fused_scores=fused_scores, precision=precision, critic_head=critic_head)
+            if not args.skip_data:
+                for workers in args.workers:
+                    report['results'] += run_isolated(data_benchmark, box_size, batch_size, args.repeats, workers=workers)
+            for r in report['results'][n:]:
+                options = " ".join("{0}={1}".format(k, r[k]) for k in ('workers', 'jit_compile', 'gp_interval', 'fused_scores', 'precision', 'critic_head') if k in r)
+                print("{0:>22} box={1} batch={2} {3}: {4:.3f} s, {5:.2f} samples/s, peak rss {6:.0f} MB".format(
+                      r['benchmark'], r['box_size'], r['batch_size'], options, r['mean_s'], r['samples_per_s'], r['peak_rss_mb']), flush=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("Results written to {0}".format(args.output), flush=True)
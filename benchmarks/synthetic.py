@@ -0,0 +1,25 @@
+import os
+import numpy as np
+from scipy.io import savemat
+
+
+def write_synthetic_data(path, box_size=64, IC_seeds=(1000, 1001), redshifts=(10,), seed=0):
+    #random cubes under path/outputs and path/IC with the simulation file names, so DataManager can read them
+    os.makedirs(path + '/outputs', exist_ok=True)
+    os.makedirs(path + '/IC', exist_ok=True)
+    rng = np.random.default_rng(seed)
+    shape = (box_size,)*3
+    for ID in IC_seeds:
+        savemat(path + '/IC/delta{0}.mat'.format(ID), {'delta': rng.normal(size=shape)})
+        savemat(path + '/IC/vbv{0}.mat'.format(ID), {'vbv': np.abs(rng.normal(size=shape))})
+        for z in redshifts:
+            savemat(path + '/outputs/T21_cube_{0}_Npix{1}_L_x_y_{2}_lin.mat'.format(z, box_size, ID), {'Tlin': 20*np.abs(rng.normal(size=shape))})
+    return path
+
+
+def synthetic_batch(box_size, batch_size, factor=2, seed=0):
+    #(T21_big, IC_delta, IC_vbv, T21_small) float32 batch in the layout of DataManager.dataset
+    rng = np.random.default_rng(seed)
+    big = (batch_size, box_size, box_size, box_size, 1)
+    small = (batch_size, box_size//factor, box_size//factor, box_size//factor, 1)
+    return tuple(rng.normal(size=shape).astype(np.float32) for shape in (big, big, big, small))
@@ -0,0 +1,162 @@
+import argparse
+import os
+import time
+import h5py
+import numpy as np
+import tensorflow as tf
+from models.wgan import Generator, set_precision
+from models.tiling import TiledGenerator
+from utils.data_manager import DataManager
+from utils.normalization import append_redshift
+
+#Emulates T21 cubes for a list of IC seeds and redshifts with a trained generator and streams them to an HDF5 file:
+#python generate.py --model 31 --seeds 1000 1100 --redshifts 6 28 --output emulated.h5
+#The generator runs on whole periodic boxes of any size through TiledGenerator, so the output has the size of the ICs.
+#Cubes that are already in the output file are skipped, so an interrupted run can just be restarted
+
+
+class CubeWriter:
+    #(N,N,N,1) array-like view of one cube of the (seeds, redshifts, N, N, N) output dataset, so TiledGenerator writes
+    #every tile straight to disk. The generator output is standardized with the low-res statistics, which are undone here
+    def __init__(self, dataset, index, mean=0., std=1.):
+        self.dataset = dataset
+        self.index = index
+        self.mean = mean
+        self.std = std
+        self.shape = (*dataset.shape[2:], 1)
+
+    def __setitem__(self, key, value):
+        self.dataset[self.index + key[:3]] = value[..., 0] * self.std + self.mean
+
+
+class Standardized:
+    #(x,y,z,channels) array-like view of a raw (x,y,z) cube that standardizes only the cells that are read, so TiledGenerator
+    #holds the windows of its current tiles rather than whole standardized boxes. z: the redshift is appended as a second
+    #channel, as in DataManager.dataset(condition=True)
+    def __init__(self, cube, mean=0., std=1., z=None):
+        self.cube = cube
+        self.mean = mean
+        self.std = std
+        self.z = z
+        self.shape = (*cube.shape[:3], 1 if z is None else 2)
+
+    def __getitem__(self, key):
+        x = ((np.asarray(self.cube[key[:3]], dtype=np.float32) - self.mean) / self.std).astype(np.float32)[..., None]
+        if self.z is not None:
+            x = append_redshift(x, self.z).numpy()
+        return x
+
+
+class StoredCube:
+    #(x,y,z) array-like of a cube in the HDF5 store, indexed with the periodic np.ix_ windows of TiledGenerator.window.
+    #A window only decompresses the chunks under it (CubeStore.read_periodic)
+    def __init__(self, store, field, ID):
+        self.store = store
+        self.field = field
+        self.ID = ID
+        self.shape = store.shape()
+
+    def __getitem__(self, key):
+        index = [np.ravel(k) for k in key]
+        size = len(index[0])
+        assert all(len(i) == size and np.array_equal(i, (np.arange(size) + i[0]) % n) for i, n in zip(index, self.shape)), \
+            "StoredCube only reads periodic cubic windows"
+        return self.store.read_periodic(self.field, self.ID, [i[0] for i in index], size)
+
+
+def raw_cube(Data, field, i):
+    #delta or vbv of seed index i as an array-like that only reads the cells that are indexed: the cache memmap, or a view
+    #of the store if the cube isn't cached
+    ID = Data.IC_seeds[i]
+    if Data.store is not None and not (Data.cache is not None and Data.cache.is_cached(field, ID)):
+        return StoredCube(Data.store, field, ID)
+    files = Data.delta_files if field == 'delta' else Data.vbv_files
+    return Data.load_cube(field, files[i], ID)
+
+
+def load_inputs(Data, i, j, low_res_mode='stride', factor=2, redshift_conditioning=False):
+    #generator inputs of seed index i and redshift index j, as in DataManager.dataset(standardize=True), as lazy views of
+    #the cached cubes (standardized when TiledGenerator reads a window), plus the low-res mean and std to undo the
+    #standardisation of the output. redshift_conditioning: the redshift is appended to vbv as in DataManager.dataset(condition=True)
+    ID, z = Data.IC_seeds[i], Data.redshifts[j]
+    T21_lr = Data.load_lr(Data.T21_files[i,j], ID, z, mode=low_res_mode, factor=factor)
+    lr_mean, lr_var = Data.lr_stats(i, j, low_res_mode, factor)[23] #23 is the unaltered box
+    vbv_mean, vbv_var = Data.vbv_stats(i)
+    lr_std = np.sqrt(lr_var) if lr_var > 0 else 1.
+    vbv_std = np.sqrt(vbv_var) if vbv_var > 0 else 1.
+    inputs = (Standardized(T21_lr, lr_mean, lr_std), Standardized(raw_cube(Data, 'delta', i)),
+              Standardized(raw_cube(Data, 'vbv', i), vbv_mean, vbv_std, z if redshift_conditioning else None))
+    return (i, j), inputs, (lr_mean, lr_std)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Emulate T21 cubes with a trained generator and stream them to an HDF5 file")
+    parser.add_argument('--path', type=str, default=os.getcwd(), help='Directory containing outputs/, IC/ and trained_models/')
+    parser.add_argument('--model', type=int, default=31, help='Generator checkpoints are read from trained_models/model_N/checkpoints')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint to restore, the latest one by default')
+    parser.add_argument('--seeds', type=int, nargs=2, default=[1000, 1010], help='IC seed range [start, stop)')
+    parser.add_argument('--redshifts', type=int, nargs=2, default=[6, 28], help='Redshift range [start, stop)')
+    parser.add_argument('--output', type=str, default=None, help='HDF5 output file, trained_models/model_N/emulated.h5 by default')
+    parser.add_argument('--batch_size', type=int, default=4, help='Tiles per generator call')
+    parser.add_argument('--tile_size', type=int, default=None, help='Output tile size, the generator training box by default')
+    parser.add_argument('--prefetch', type=int, default=4, help='Batches of tiles read ahead of the generator')
+    parser.add_argument('--low_res_mode', type=str, default='stride', help='Low-res operator the model was trained with')
+    parser.add_argument('--jit_compile', action='store_true', help='Compile the generator with XLA')
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16', 'float16'], help='Compute dtype of the generator')
+    parser.add_argument('--cache_dtype', type=str, default='float32', choices=['float32', 'float16'], help='Storage dtype of the cached cubes')
+    parser.add_argument('--store', type=str, default=None, help='Read the cubes from this chunked HDF5 store (python -m utils.cube_store) instead of outputs/ and IC/')
+    parser.add_argument('--redshift_conditioning', action='store_true', help='The model was trained on several redshifts (GAN.py --redshifts)')
+    parser.add_argument('--overwrite', action='store_true', help='Emulate every cube again if the output file was written with another checkpoint or low-res mode')
+    args = parser.parse_args()
+
+    model_path = args.path + "/trained_models/model_{0}".format(args.model)
+    output = args.output if args.output is not None else model_path + "/emulated.h5"
+
+    set_precision(args.precision)
+    generator = Generator(vbv_shape=(1,128,128,128,1+args.redshift_conditioning), jit_compile=args.jit_compile)
+    ckpt = tf.train.Checkpoint(generator_model=generator.model)
+    manager = tf.train.CheckpointManager(ckpt, model_path+"/checkpoints", max_to_keep=None)
+    checkpoint = args.checkpoint if args.checkpoint is not None else manager.latest_checkpoint
+    assert checkpoint is not None, "No checkpoint found in {0}".format(model_path+"/checkpoints")
+    ckpt.restore(checkpoint).expect_partial()
+    print("Restored generator from {0}".format(checkpoint), flush=True)
+
+    Data = DataManager(args.path, redshifts=list(range(*args.redshifts)), IC_seeds=list(range(*args.seeds)), cache_dtype=args.cache_dtype, store=args.store)
+    Data.T21_files, Data.delta_files, Data.vbv_files = Data.get_file_lists()
+    factor = generator.upsampling
+    box_size = raw_cube(Data, 'delta', 0).shape[0]
+    tiled = TiledGenerator(generator, tile_size=args.tile_size, batch_size=args.batch_size)
+    chunk = min(tiled.tiles(box_size)[1], box_size)
+
+    with h5py.File(output, 'a') as f:
+        shape = (len(Data.IC_seeds), len(Data.redshifts), box_size, box_size, box_size)
+        if 'T21' not in f:
+            f.create_dataset('T21', shape=shape, dtype=np.float32, chunks=(1, 1, chunk, chunk, chunk))
+            f.create_dataset('IC_seeds', data=np.array(Data.IC_seeds))
+            f.create_dataset('redshifts', data=np.array(Data.redshifts))
+            f.create_dataset('done', shape=shape[:2], dtype=bool)
+        assert f['T21'].shape == shape and list(f['IC_seeds'][:]) == list(Data.IC_seeds) and list(f['redshifts'][:]) == list(Data.redshifts), \
+            "{0} was written for other seeds or redshifts".format(output)
+        #a restarted run only continues a file written by the same model, the cubes would otherwise come from two of them
+        written = {key: f.attrs[key] for key in ('checkpoint', 'low_res_mode') if key in f.attrs}
+        if written != {} and written != {'checkpoint': checkpoint, 'low_res_mode': args.low_res_mode}:
+            assert args.overwrite, "{0} was written with {1}, use --overwrite to emulate every cube again".format(output, written)
+            f['done'][...] = False
+        f.attrs['checkpoint'] = checkpoint
+        f.attrs['low_res_mode'] = args.low_res_mode
+
+        todo = [(i, j) for i in range(shape[0]) for j in range(shape[1]) if not f['done'][i, j]]
+        print("Emulating {0} of {1} cubes into {2}".format(len(todo), shape[0]*shape[1], output), flush=True)
+
+        def samples():
+            for i, j in todo:
+                _, inputs, (mean, std) = load_inputs(Data, i, j, low_res_mode=args.low_res_mode, factor=factor, redshift_conditioning=args.redshift_conditioning)
+                yield (*inputs, CubeWriter(f['T21'], (i, j), mean, std))
+
+        #the windows of the next tiles are read (and standardized) in the background, memory is bound by tiles, not boxes
+        start = time.time()
+        for n, out in enumerate(tiled.run(samples(), prefetch=args.prefetch)):
+            f['done'][out.index] = True
+            f.flush()
+            if (n+1) % 10 == 0 or n+1 == len(todo):
+                print("{0}/{1} cubes, {2:.2f} cubes/s".format(n+1, len(todo), (n+1)/(time.time()-start)), flush=True)
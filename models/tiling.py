@@ -0,0 +1,119 @@
+import math
+import queue
+import threading
+import numpy as np
+import tensorflow as tf
+
+
+class TiledGenerator:
+    #Runs a Generator on periodic boxes of any size (e.g. 256^3 or 512^3) by splitting them into overlapping tiles.
+    #Each output tile of size tile_size needs an input window with generator.crop extra cells on every side (the halo
+    #the valid convolutions remove). The windows are gathered with periodic wrap, so the stitched output is the same as
+    #one pass over the whole box with periodic padding, without ever holding more than batch_size windows in memory.
+    #The inputs are the standardized model inputs of the whole box, with shapes (x,y,z,channels): per-tile
+    #standardisation would leave seams. They can be np.memmaps or lazy array-likes (a shape and numpy indexing, e.g. the
+    #views in generate.py that standardize the cells they read), only the cells of the current tiles are read.
+    def __init__(self, generator, tile_size=None, batch_size=1):
+        self.generator = generator
+        self.halo = generator.crop
+        self.factor = generator.upsampling
+        #the window of a tile has to start on a low-res cell, so the tile origins are multiples of factor (shifted by the halo)
+        assert (2*self.halo) % self.factor == 0, "halo of {0} cells doesn't line up with the {1}x upsampling".format(self.halo, self.factor)
+        self.tile_size = tile_size if tile_size is not None else generator.model.output_shape[1] #the training box by default
+        self.batch_size = batch_size
+
+    def tiles(self, box_size):
+        #output origins along one axis and the tile size actually used: the fewest tiles of at most self.tile_size cells
+        #(rounded to a multiple of factor) that cover the box. The last tile may wrap around and overlap the first
+        n_tiles = math.ceil(box_size / self.tile_size)
+        tile_size = self.factor * math.ceil(box_size / n_tiles / self.factor)
+        offset = self.halo % self.factor
+        return [offset + i*tile_size for i in range(n_tiles)], tile_size
+
+    @staticmethod
+    def window(x, origin, size, factor=1):
+        #periodic (size,size,size) window of x starting at origin (in high-res cells), x has 1/factor the resolution
+        index = [(np.arange(size//factor) + o//factor) % n for o,n in zip(origin, x.shape[:3])]
+        return np.asarray(x[np.ix_(*index)], dtype=np.float32)
+
+    @staticmethod
+    def write(out, tile, origin):
+        #writes tile into out at origin, split into contiguous pieces where it wraps around the box
+        pieces = []
+        for o,t,n in zip(origin, tile.shape[:3], out.shape[:3]):
+            o = o % n
+            pieces.append([(o, 0, min(t, n-o))] + ([(0, n-o, t)] if o+t > n else []))
+        for (ox,ax,bx) in pieces[0]:
+            for (oy,ay,by) in pieces[1]:
+                for (oz,az,bz) in pieces[2]:
+                    out[ox:ox+bx-ax, oy:oy+by-ay, oz:oz+bz-az] = tile[ax:bx, ay:by, az:bz]
+
+    def origins(self, box_size):
+        starts, tile_size = self.tiles(box_size)
+        return [(i,j,k) for i in starts for j in starts for k in starts], tile_size
+
+    def __call__(self, T21_lr, delta, vbv, out=None):
+        #T21_lr: (N/factor,)*3+(channels,), delta and vbv: (N,N,N,channels). Returns (or fills) out with shape (N,N,N,1)
+        for out in self.run([(T21_lr, delta, vbv, out)]):
+            return out
+
+    def batches(self, samples):
+        #the tiles of samples in batches of batch_size, each tile as (n, out, tiles, origin, windows): sample n (with tiles
+        #tiles in all) is written to out, windows are the input windows of the tile at origin. The tiles of consecutive
+        #samples share batches, so boxes smaller than a batch of tiles still fill it
+        batch = []
+        for n, (T21_lr, delta, vbv, out) in enumerate(samples):
+            box_size = delta.shape[0]
+            assert delta.shape[:3] == (box_size,)*3 and vbv.shape[:3] == (box_size,)*3, "delta and vbv must be cubes of the same size"
+            assert T21_lr.shape[:3] == (box_size//self.factor,)*3, "T21_lr must be {0}x smaller than delta".format(self.factor)
+            if out is None:
+                out = np.zeros((box_size,)*3 + (self.generator.model.output_shape[-1],), dtype=np.float32)
+
+            origins, tile_size = self.origins(box_size)
+            size = tile_size + 2*self.halo
+            for origin in origins:
+                start = tuple(o - self.halo for o in origin)
+                windows = (self.window(T21_lr, start, size, self.factor), self.window(delta, start, size), self.window(vbv, start, size))
+                batch.append((n, out, len(origins), origin, windows))
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def run(self, samples, prefetch=0):
+        #samples: iterable of (T21_lr, delta, vbv, out) tuples, out can be None. Yields each out once all of its tiles are written.
+        #prefetch: batches of tile windows read ahead in a background thread (samples is iterated there too), so reading
+        #the inputs overlaps the generator while at most prefetch batches of windows are held besides the current one
+        remaining = {}
+        batches = self.batches(samples) if prefetch == 0 else read_ahead(self.batches(samples), prefetch)
+        for batch in batches:
+            generated = self.generator(*[tf.constant(np.stack([windows[c] for *_, windows in batch])) for c in range(3)]).numpy()
+            for (n, out, tiles, origin, _), tile in zip(batch, generated):
+                self.write(out, tile, origin)
+                remaining[n] = remaining.get(n, tiles) - 1
+                if remaining[n] == 0: #the tiles come in sample order, so the samples are finished in order
+                    del remaining[n]
+                    yield out
+
+
+def read_ahead(iterable, depth):
+    #yields the items of iterable, which is iterated in a background thread at most depth items ahead.
+    #An exception raised by iterable is raised here
+    items = queue.Queue(maxsize=depth)
+    end = object()
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+            items.put((end, None))
+        except Exception as e:
+            items.put((end, e))
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is end:
+            return
+        yield item
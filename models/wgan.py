@@ -1,13 +1,105 @@
+import collections
+import contextlib
+import itertools
 import tensorflow as tf
 
+#number of times each compiled function has been traced, per (function, instance, replica): strategy.run traces a step
+#once on every replica, and a sweep or benchmark builds several models. Anything above 1 after the first epoch is a retrace
+trace_counts = collections.Counter()
+instance_ids = itertools.count()
+
+def count_trace(name, instance):
+    context = tf.distribute.get_replica_context() #None in a cross-replica context
+    replica = tf.get_static_value(context.replica_id_in_sync_group) if context is not None else None
+    trace_counts[(name, instance.instance_id, None if replica is None else int(replica))] += 1
+
+def log_trace_counts():
+    #the highest count of every function over its instances and replicas
+    highest = {}
+    for (name, _, _), count in trace_counts.items():
+        highest[name] = max(highest.get(name, 0), count)
+    print("Trace counts: ", highest, flush=True)
+
+def crop3d(x, crop):
+    #Cropping3D as a plain slice of the x,y,z axes
+    return x[:, crop:tf.shape(x)[1]-crop, crop:tf.shape(x)[2]-crop, crop:tf.shape(x)[3]-crop, :]
+
+def jit_function(fn, input_signature, jit_compile=False, probe_args=None):
+    #tf.function of fn, compiled with XLA if jit_compile=True. With probe_args the XLA build is checked up front
+    #(lowered to HLO, nothing is executed) and the plain graph function is used if an op isn't supported by XLA
+    function = tf.function(fn, input_signature=input_signature, jit_compile=jit_compile)
+    if jit_compile and probe_args is not None:
+        counts = trace_counts.copy()
+        try:
+            function.experimental_get_compiler_ir(*probe_args)(stage='hlo')
+        except (ValueError, tf.errors.OpError) as e:
+            print("XLA can't compile {0}, falling back to a graph function: {1}".format(getattr(fn, '__qualname__', fn), str(e).splitlines()[0]), flush=True)
+            #the fallback replaces the probed function rather than retracing it: it is traced now and every function
+            #keeps one trace, from whichever of the two traced it
+            probed = trace_counts.copy()
+            trace_counts.clear()
+            trace_counts.update(counts)
+            function = tf.function(fn, input_signature=input_signature)
+            function.get_concrete_function(*probe_args)
+            for key, count in probed.items():
+                trace_counts[key] = max(trace_counts[key], count)
+    return function
+
+def probe_tensors(input_signature):
+    #batch of one zero tensor per TensorSpec, used to check the XLA build of a function
+    return [tf.zeros([1 if n is None else n for n in spec.shape], dtype=spec.dtype) for spec in input_signature]
+
+def set_precision(precision='float32'):
+    #'bfloat16' or 'float16': mixed precision, the layers compute in that dtype and keep float32 variables (and optimizer
+    #state). Models built after the call use it. Their outputs are cast back to float32, so the losses, the gradient
+    #penalty norm and the standardisation all stay float32. 'float16' also needs a LossScaleOptimizer (see scale_loss)
+    policies = {'float32': 'float32', 'bfloat16': 'mixed_bfloat16', 'float16': 'mixed_float16'}
+    assert precision in policies, "precision must be one of {0}".format(list(policies))
+    tf.keras.mixed_precision.set_global_policy(policies[precision])
+
+def scale_loss(optimizer, loss):
+    #loss multiplied by the loss scale of a LossScaleOptimizer, so small float16 gradients don't underflow. Call inside the tape.
+    #Keras 3 (scale_loss): apply_gradients of the optimizer unscales the gradients and skips steps with non-finite ones.
+    #tf_keras (get_scaled_loss, TF_USE_LEGACY_KERAS=1): the gradients are unscaled by unscale_gradients
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        if hasattr(optimizer, 'get_scaled_loss'):
+            return optimizer.get_scaled_loss(loss)
+        return optimizer.scale_loss(loss)
+    return loss
+
+def unscale_gradients(optimizer, gradients):
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer) and hasattr(optimizer, 'get_unscaled_gradients'):
+        return optimizer.get_unscaled_gradients(gradients)
+    return gradients
+
+#the models are fully convolutional, so one trace of call covers every batch size and box size
+call_signature = [tf.TensorSpec(shape=(None,None,None,None,None), dtype=tf.float32)]*3
+
 class Critic(tf.keras.Model):
-    def __init__(self,kernel_sizes=[7,5,3,1],lbda=1e-2, activation='tanh'):
-        super(Critic, self).__init__()
+    def __init__(self,kernel_sizes=[7,5,3,1],lbda=1e-2, activation='tanh', jit_compile=False, gp_interval=1, fused_scores=False, head='dense'):
+        super(Critic, self).__init__(dtype='float32') #float32 inputs and outputs, only self.model uses the mixed precision policy
+        self.instance_id = next(instance_ids)
         self.kernel_sizes = kernel_sizes
         self.crop = int((max(self.kernel_sizes)-1))
         self.lbda = lbda
         self.activation = activation
+        #head='dense': Flatten and Dense over the whole last feature map, so the critic is tied to one box size.
+        #head='pool': global average of the last feature map and a Dense on its 64 channels, so the same weights score
+        #patches and full boxes (needed for patch training, see DataManager.dataset(patch_size=...)). The checkpoints differ
+        assert head in ('dense', 'pool'), "head must be 'dense' or 'pool'"
+        self.head = head
+        #gp_interval=k: lazy regularisation, the gradient penalty (a second backward pass through the critic) is only
+        #computed every k-th critic step and scaled by k, so it has the same weight on average
+        self.gp_interval = gp_interval
+        #fused_scores: the real and generated boxes are scored in one critic call on a batch of twice the size
+        self.fused_scores = fused_scores
         self.build_critic_model()
+        #the input size is only fixed once the model is built, WGANTrainer rebuilds forward with a probe then
+        self.build_forward(jit_compile)
+
+    def build_forward(self, jit_compile=False, probe_args=None):
+        self.jit_compile = jit_compile
+        self.forward = jit_function(self.forward_fn, call_signature, jit_compile, probe_args)
 
     def build_critic_model(self):
         conv1 = tf.keras.layers.Conv3D(filters=8, kernel_size=(self.kernel_sizes[0], self.kernel_sizes[0], self.kernel_sizes[0]), 
@@ -37,7 +129,7 @@ class Critic(tf.keras.Model):
                                             strides=(1, 1, 1), padding='valid', data_format="channels_last", 
                                             activation=tf.keras.layers.Activation(self.activation)#tf.keras.layers.LeakyReLU(alpha=0.1)
                                             )
-        flatten = tf.keras.layers.Flatten()
+        flatten = tf.keras.layers.Flatten() if self.head == 'dense' else tf.keras.layers.GlobalAveragePooling3D(data_format="channels_last")
         out = tf.keras.layers.Dense(units=1,
                                          kernel_initializer=tf.keras.initializers.RandomNormal(mean=0.0, stddev=0.1, seed=None),
                                          bias_initializer=tf.keras.initializers.Constant(value=0.1),
@@ -46,19 +138,16 @@ class Critic(tf.keras.Model):
         self.model = tf.keras.Sequential([conv1, conv2, conv3, conv4, flatten, out])    
         return self.model
 
-    @tf.function
-    def critic_loss(self, T21_big, IC_delta, IC_vbv, generated_boxes):
-        #wasserstein loss
-        # Generate a batch of fake big boxes using the generator network
-        T21_big = tf.keras.layers.Cropping3D(cropping=(self.crop,self.crop,self.crop),data_format="channels_last")(T21_big)
-        IC_delta = tf.keras.layers.Cropping3D(cropping=(self.crop,self.crop,self.crop),data_format="channels_last")(IC_delta)
-        IC_vbv = tf.keras.layers.Cropping3D(cropping=(self.crop,self.crop,self.crop),data_format="channels_last")(IC_vbv)
-
-        # Evaluate the critic network on the real big boxes and the fake big boxes
-        W_real = self.call(T21_big, IC_delta, IC_vbv)
-        W_gen = self.call(generated_boxes, IC_delta, IC_vbv)
+    def min_input_size(self):
+        #smallest box edge the valid convolutions of the critic leave at least one cell of
+        size = 1
+        for layer in reversed(self.model.layers):
+            if isinstance(layer, tf.keras.layers.Conv3D):
+                size = (size - 1)*layer.strides[0] + layer.kernel_size[0]
+        return size
 
-        epsilon = tf.random.uniform(shape=[T21_big.shape[0], 1, 1, 1, 1], minval=0., maxval=1., seed=None)
+    def gradient_penalty(self, T21_big, IC_delta, IC_vbv, generated_boxes):
+        epsilon = tf.random.uniform(shape=[tf.shape(T21_big)[0], 1, 1, 1, 1], minval=0., maxval=1., seed=None)
         # Compute the interpolated difference between the real and generated samples
         xhat = epsilon * T21_big + (1 - epsilon) * generated_boxes
 
@@ -67,8 +156,31 @@ class Critic(tf.keras.Model):
             tape.watch(xhat)
             critic_output = self.call(xhat, IC_delta, IC_vbv)
         gradients = tape.gradient(critic_output, xhat)
-        l2_norm = tf.math.reduce_euclidean_norm(gradients, axis=[1,2,3])
-        gp = self.lbda * tf.square(l2_norm - 1)
+        l2_norm = tf.sqrt(tf.reduce_sum(tf.square(gradients), axis=[1,2,3])) #same as reduce_euclidean_norm, which XLA has no kernel for
+        return self.lbda * tf.square(l2_norm - 1)
+
+    def critic_loss(self, T21_big, IC_delta, IC_vbv, generated_boxes, apply_gp=True):
+        #wasserstein loss
+        #apply_gp: whether this step computes the (lazy) gradient penalty, a bool tensor when gp_interval > 1.
+        #The returned gp is the penalty as applied: scaled by gp_interval on the steps that compute it and zero on the others
+        # Generate a batch of fake big boxes using the generator network
+        T21_big = crop3d(T21_big, self.crop)
+        IC_delta = crop3d(IC_delta, self.crop)
+        IC_vbv = crop3d(IC_vbv, self.crop)
+
+        # Evaluate the critic network on the real big boxes and the fake big boxes
+        if self.fused_scores:
+            W = self.call(tf.concat([T21_big, generated_boxes], axis=0), tf.concat([IC_delta, IC_delta], axis=0), tf.concat([IC_vbv, IC_vbv], axis=0))
+            W_real, W_gen = tf.split(W, 2, axis=0)
+        else:
+            W_real = self.call(T21_big, IC_delta, IC_vbv)
+            W_gen = self.call(generated_boxes, IC_delta, IC_vbv)
+
+        if self.gp_interval == 1:
+            gp = self.gradient_penalty(T21_big, IC_delta, IC_vbv, generated_boxes)
+        else:
+            gp = tf.cond(apply_gp, lambda: self.gp_interval * self.gradient_penalty(T21_big, IC_delta, IC_vbv, generated_boxes),
+                         lambda: tf.zeros_like(W_real))
         
         #plotting: need to remove tf.function decorator to plot histograms and imshows (e is epoch and i is batch number)
         if False:
@@ -97,28 +209,33 @@ class Critic(tf.keras.Model):
 
         return loss, gp 
 
-    @tf.function
     def train_step_critic(self, T21_big, IC_delta, IC_vbv, T21_small, optimizer, generator):
         #
         #Function that performs one training step for the critic network.
         #The function calls the loss function for the critic network, computes the gradients,
         #and applies the gradients to the network's parameters.
+        #Not compiled on its own: WGANTrainer traces it inside a tf.function with a fixed input signature
         #
 
         with tf.GradientTape() as disc_tape:
             generated_boxes = generator(T21_small, IC_delta, IC_vbv)
-            crit_loss, gp = self.critic_loss(T21_big, IC_delta, IC_vbv, generated_boxes)
+            apply_gp = tf.equal(optimizer.iterations % self.gp_interval, 0)
+            crit_loss, gp = self.critic_loss(T21_big, IC_delta, IC_vbv, generated_boxes, apply_gp)
+            scaled_loss = scale_loss(optimizer, crit_loss / tf.distribute.get_replica_context().num_replicas_in_sync) #apply_gradients sums the gradients of the replicas
 
-        grad_disc = disc_tape.gradient(crit_loss, self.model.trainable_variables)
+        grad_disc = unscale_gradients(optimizer, disc_tape.gradient(scaled_loss, self.model.trainable_variables))
         optimizer.apply_gradients(zip(grad_disc, self.model.trainable_variables))
         
         return crit_loss, gp
     
-    @tf.function
-    def call(self, T21_target, IC_delta, IC_vbv):
+    def forward_fn(self, T21_target, IC_delta, IC_vbv):
+        count_trace('Critic.call', self)
         data_target = tf.concat((T21_target, IC_delta, IC_vbv), axis=4)
         x_out_model = self.model(data_target)
-        return x_out_model
+        return tf.cast(x_out_model, tf.float32) #computed in the mixed precision dtype, if set
+
+    def call(self, T21_target, IC_delta, IC_vbv):
+        return self.forward(T21_target, IC_delta, IC_vbv)
 
 class InceptionLayer(tf.keras.layers.Layer):
     def __init__(self, input_channels=1, filters_1x1x1_7x7x7=6, filters_7x7x7=6, filters_1x1x1_5x5x5=6, filters_5x5x5=6, filters_1x1x1_3x3x3=6, filters_3x3x3=6, filters_1x1x1=6):
@@ -209,24 +326,70 @@ class InceptionLayer(tf.keras.layers.Layer):
         #The 1x1x1 convolution is basically a weighted average of channels,
         # or linear transformation, with learned weights.
         #Update: implemented 1x1x1 convolution to reduce number of channels
-        if self.input_channels > x_out.shape[-1]:
+        #(also used to project inputs with fewer channels than the output, e.g. vbv with the redshift channel)
+        if self.input_channels > 1:
             x_out_ = self.conv_1x1x1_reduce_channels(x_out_)
         else:
             x_out_ = tf.keras.layers.Lambda(lambda x: tf.tile(x, [1, 1, 1, 1, x_out.shape[-1]]))(x_out_)
         return tf.add(x_out, x_out_)
 
 
+class FusedInceptionLayer(InceptionLayer):
+    #Same layers and variables as InceptionLayer (checkpoints load into either), with a cheaper call:
+    #the four 1x1x1 projections of x run as one conv whose output channels are split between the branches,
+    #the 5x5x5 and 3x3x3 branches are cropped before their conv (a pointwise conv commutes with the crop) so no
+    #output is computed only to be thrown away, and the single channel residual is broadcast instead of tiled
+    def build(self, input_shape):
+        #variables are created in the order InceptionLayer.call creates them, so trainable_variables line up too
+        input_shape = tf.TensorShape(input_shape)
+        self.pointwise = [self.conv_1x1x1_7x7x7, self.conv_1x1x1_5x5x5, self.conv_1x1x1_3x3x3, self.conv_1x1x1]
+        def build_conv(conv, shape):
+            with tf.name_scope(conv.name):
+                conv.build(shape)
+        for pointwise, conv in zip(self.pointwise, [self.conv_7x7x7, self.conv_5x5x5, self.conv_3x3x3, None]):
+            build_conv(pointwise, input_shape)
+            if conv is not None:
+                build_conv(conv, input_shape[:-1].concatenate([pointwise.filters]))
+        if self.input_channels > 1:
+            build_conv(self.conv_1x1x1_reduce_channels, input_shape)
+        super(FusedInceptionLayer, self).build(input_shape)
+
+    def call(self, x):
+        kernel = tf.concat([conv.kernel for conv in self.pointwise], axis=-1)
+        bias = tf.concat([conv.bias for conv in self.pointwise], axis=-1)
+        x_pointwise = tf.nn.conv3d(x, tf.cast(kernel, x.dtype), strides=[1,1,1,1,1], padding='VALID') + tf.cast(bias, x.dtype)
+        x1, x2, x3, x4 = tf.split(x_pointwise, [conv.filters for conv in self.pointwise], axis=-1)
+
+        x1 = self.conv_7x7x7(x1)
+        x2 = self.conv_5x5x5(crop3d(x2, 1))
+        x3 = self.conv_3x3x3(crop3d(x3, 2))
+        x4 = crop3d(x4, 3)
+        x_out = tf.concat([x1, x2, x3, x4], axis=4)
+
+        x_out_ = crop3d(x, 3)
+        if self.input_channels > 1:
+            x_out_ = self.conv_1x1x1_reduce_channels(x_out_)
+        return x_out + x_out_
+
 
 class Generator(tf.keras.Model):
     def __init__(self, T21_shape=(1,64,64,64,1), delta_shape=(1,128,128,128,1), vbv_shape=(1,128,128,128,1),
-                 activation='tanh'):
-        super(Generator, self).__init__()
+                 activation='tanh', jit_compile=False, fused_inception=True):
+        super(Generator, self).__init__(dtype='float32') #float32 inputs and outputs, only self.model uses the mixed precision policy
+        self.instance_id = next(instance_ids)
         self.T21_shape = T21_shape
         self.delta_shape = delta_shape
-        self.vbv_shape = vbv_shape
+        self.vbv_shape = vbv_shape #vbv_shape[-1]=2 for the redshift-conditioned model, see utils/normalization.append_redshift
         self.upsampling = int(delta_shape[1]/T21_shape[1])
         self.activation = activation
+        self.inception_layer = FusedInceptionLayer if fused_inception else InceptionLayer
         self.build_generator_model()
+        self.build_forward(jit_compile)
+
+    def build_forward(self, jit_compile=False):
+        self.jit_compile = jit_compile
+        probe_args = probe_tensors([tf.TensorSpec(shape=(None, *shape[1:])) for shape in (self.T21_shape, self.delta_shape, self.vbv_shape)])
+        self.forward = jit_function(self.forward_fn, call_signature, jit_compile, probe_args)
 
     def build_generator_model(self):
         inputs_T21 = tf.keras.layers.Input(shape=self.T21_shape[1:]) #not including the batch size according to docs
@@ -234,19 +397,19 @@ class Generator(tf.keras.Model):
         inputs_vbv = tf.keras.layers.Input(shape=self.vbv_shape[1:])
 
         T21 = tf.keras.layers.UpSampling3D(size=self.upsampling, data_format="channels_last")(inputs_T21)
-        T21 = InceptionLayer(input_channels=inputs_T21.shape[-1])(T21) #tf.keras.layers.Lambda(self.inception__)(T21) #self.inception__(T21)
+        T21 = self.inception_layer(input_channels=inputs_T21.shape[-1])(T21) #tf.keras.layers.Lambda(self.inception__)(T21) #self.inception__(T21)
         #change to tanh activation#T21 = tf.keras.layers.LeakyReLU(alpha=0.1)(T21) #nn.leaky_relu(T21, 0.1)
         T21 = tf.keras.layers.Activation(self.activation)(T21)
         
-        delta = InceptionLayer(input_channels=inputs_delta.shape[-1])(inputs_delta) #tf.keras.layers.Lambda(self.inception__)(inputs_delta) #self.inception__(inputs_delta)
+        delta = self.inception_layer(input_channels=inputs_delta.shape[-1])(inputs_delta) #tf.keras.layers.Lambda(self.inception__)(inputs_delta) #self.inception__(inputs_delta)
         delta = tf.keras.layers.LeakyReLU(alpha=0.1)(delta) #tf.nn.leaky_relu(delta, 0.1)
 
-        vbv = InceptionLayer(input_channels=inputs_vbv.shape[-1])(inputs_vbv) #tf.keras.layers.Lambda(self.inception__)(inputs_vbv)
+        vbv = self.inception_layer(input_channels=inputs_vbv.shape[-1])(inputs_vbv) #tf.keras.layers.Lambda(self.inception__)(inputs_vbv)
         vbv = tf.keras.layers.Activation(self.activation)(vbv) #tf.keras.layers.LeakyReLU(alpha=0.1)(vbv) #tf.nn.leaky_relu(vbv, 0.1)
 
         data = tf.keras.layers.Concatenate(axis=4)([T21, delta, vbv])
         
-        data = InceptionLayer(input_channels=data.shape[-1])(data) #tf.keras.layers.Lambda(self.inception__)(data)
+        data = self.inception_layer(input_channels=data.shape[-1])(data) #tf.keras.layers.Lambda(self.inception__)(data)
         data = tf.keras.layers.Activation(self.activation)(data)#tf.keras.layers.LeakyReLU(alpha=0.1)(data) #tf.nn.leaky_relu(data, 0.1)
         data = tf.keras.layers.Conv3D(filters=1,#data.shape[-1], 
                                       kernel_size=(1, 1, 1),
@@ -258,13 +421,13 @@ class Generator(tf.keras.Model):
         #data = tf.keras.layers.ReLU()(data) 
         
         self.model = tf.keras.Model(inputs=[inputs_T21, inputs_delta, inputs_vbv], outputs=data)
+        self.crop = (self.delta_shape[1] - self.model.output_shape[1])//2 #halo removed by the valid convolutions
         return self.model
 
-    @tf.function
     def generator_loss(self, T21_big, IC_delta, IC_vbv, generated_boxes, critic):
-        T21_big = tf.keras.layers.Cropping3D(cropping=(6, 6, 6),data_format="channels_last")(T21_big)
-        IC_delta = tf.keras.layers.Cropping3D(cropping=(6, 6, 6),data_format="channels_last")(IC_delta)
-        IC_vbv = tf.keras.layers.Cropping3D(cropping=(6, 6, 6),data_format="channels_last")(IC_vbv)
+        T21_big = crop3d(T21_big, self.crop)
+        IC_delta = crop3d(IC_delta, self.crop)
+        IC_vbv = crop3d(IC_vbv, self.crop)
         
         #W_real = critic(T21_big, IC_delta, IC_vbv)
         W_gen = critic(generated_boxes, IC_delta, IC_vbv)
@@ -272,24 +435,162 @@ class Generator(tf.keras.Model):
         loss = - tf.reduce_mean(W_gen) #- tf.reduce_mean(W_real - W_gen)
         return loss
 
-    @tf.function
     def train_step_generator(self, T21_small, T21_big, IC_delta, IC_vbv, optimizer, critic):
         #
         #Function that performs one training step for the generator network.
         #The function calls the loss function for the generator network, computes the gradients,
         #and applies the gradients to the network's parameters.
+        #Not compiled on its own: WGANTrainer traces it inside a tf.function with a fixed input signature
         #
 
         with tf.GradientTape() as gen_tape: 
             generated_boxes = self.call(T21_small, IC_delta, IC_vbv)
             #generated_output = Critic(generated_boxes, IC_delta, IC_vbv)
             gen_loss = self.generator_loss(T21_big, IC_delta, IC_vbv, generated_boxes, critic)
+            scaled_loss = scale_loss(optimizer, gen_loss / tf.distribute.get_replica_context().num_replicas_in_sync) #apply_gradients sums the gradients of the replicas
 
-        grad_gen = gen_tape.gradient(gen_loss, self.model.trainable_variables)
+        grad_gen = unscale_gradients(optimizer, gen_tape.gradient(scaled_loss, self.model.trainable_variables))
         optimizer.apply_gradients(zip(grad_gen, self.model.trainable_variables))
 
         return gen_loss
         
-    @tf.function    
+    def forward_fn(self, T21_train, IC_delta, IC_vbv):
+        count_trace('Generator.call', self)
+        return tf.cast(self.model(inputs=[T21_train, IC_delta, IC_vbv]), tf.float32) #computed in the mixed precision dtype, if set
+
     def call(self, T21_train, IC_delta, IC_vbv):
-        return self.model(inputs=[T21_train, IC_delta, IC_vbv])
\ No newline at end of file
+        return self.forward(T21_train, IC_delta, IC_vbv)
+
+
+class WGANTrainer(tf.Module):
+    def __init__(self, generator, critic, generator_optimizer, critic_optimizer, n_critic=10, jit_compile=False, strategy=None):
+        #strategy: the tf.distribute strategy the models, optimizers and trainer are created under (see utils/distribute.py).
+        #Every replica runs the train steps, gradient penalty included, on its part of the global batch. apply_gradients sums
+        #the gradients of the replicas and the returned losses are averaged over them. train_cycle then takes a distributed iterator
+        super(WGANTrainer, self).__init__()
+        self.instance_id = next(instance_ids)
+        self.generator = generator
+        self.critic = critic
+        self.generator_optimizer = generator_optimizer
+        self.critic_optimizer = critic_optimizer
+        self.n_critic = n_critic
+        self.strategy = strategy
+
+        #losses are accumulated on the device (per replica, they are summed when read), read them with .result() once per epoch
+        self.critic_loss_metric = tf.keras.metrics.Mean(name='critic_loss')
+        self.gradient_penalty_metric = tf.keras.metrics.Mean(name='gradient_penalty')
+        self.generator_loss_metric = tf.keras.metrics.Mean(name='generator_loss')
+
+        #batch size is the only free dimension, so a smaller last batch doesn't retrace
+        T21_shape, delta_shape, vbv_shape = self.generator.T21_shape, self.generator.delta_shape, self.generator.vbv_shape
+        self.input_signature = (tf.TensorSpec(shape=(None, *delta_shape[1:-1], T21_shape[-1]), dtype=tf.float32),
+                                tf.TensorSpec(shape=(None, *delta_shape[1:]), dtype=tf.float32),
+                                tf.TensorSpec(shape=(None, *vbv_shape[1:]), dtype=tf.float32),
+                                tf.TensorSpec(shape=(None, *T21_shape[1:]), dtype=tf.float32),
+                                )
+
+        #variables can't be created inside the training loop of train_cycle, so build the critic and both optimizers now
+        critic_channels = self.generator.model.output_shape[-1] + self.generator.delta_shape[-1] + self.generator.vbv_shape[-1]
+        self.critic.model.build((None, *self.generator.model.output_shape[1:-1], critic_channels))
+        self.generator_optimizer.build(self.generator.model.trainable_variables)
+        self.critic_optimizer.build(self.critic.model.trainable_variables)
+
+        #XLA for the train steps (the iterator ops of train_cycle can't be compiled, so train_cycle itself stays a graph function).
+        #The steps call the models inline, so their XLA cluster also covers both forward passes and the gradient penalty tape
+        if self.critic.jit_compile:
+            out_shape = self.generator.model.output_shape[1:-1]
+            self.critic.build_forward(True, probe_args=probe_tensors([tf.TensorSpec(shape=(None, *out_shape, shape[-1]))
+                                                                      for shape in (self.generator.model.output_shape, delta_shape, vbv_shape)]))
+        if strategy is None:
+            probe_args = probe_tensors(self.input_signature) if jit_compile else None
+            self.train_step_critic = jit_function(self._train_step_critic, self.input_signature, jit_compile, probe_args)
+            self.train_step_generator = jit_function(self._train_step_generator, self.input_signature, jit_compile, probe_args)
+            self.train_cycle = tf.function(self._train_cycle, input_signature=[tf.data.IteratorSpec(self.input_signature)])
+        else:
+            #the steps take per replica batches and the whole strategy.run is one tf.function: the gradient all-reduce in
+            #apply_gradients can't be inside a nested tf.function, so the train steps aren't XLA compiled here (the model calls still are)
+            self.train_step_critic = tf.function(lambda *batch: self.reduce_mean(strategy.run(self._train_step_critic, args=batch)))
+            self.train_step_generator = tf.function(lambda *batch: self.reduce_mean(strategy.run(self._train_step_generator, args=batch)))
+            self.train_cycle = self.stepwise_cycle
+
+    def reduce_mean(self, values):
+        return tf.nest.map_structure(lambda value: self.strategy.reduce(tf.distribute.ReduceOp.MEAN, value, axis=None), values)
+
+    def _train_step_critic(self, T21_big, IC_delta, IC_vbv, T21_small):
+        #returns the critic loss and the mean gradient penalty of the batch. The metrics are updated here, inside the replica
+        count_trace('WGANTrainer.train_step_critic', self)
+        crit_loss, gp = self.critic.train_step_critic(T21_big, IC_delta, IC_vbv, T21_small, self.critic_optimizer, self.generator)
+        self.critic_loss_metric.update_state(crit_loss)
+        self.gradient_penalty_metric.update_state(gp)
+        return tf.cast(crit_loss, tf.float32), tf.cast(tf.reduce_mean(gp), tf.float32)
+
+    def _train_step_generator(self, T21_big, IC_delta, IC_vbv, T21_small):
+        count_trace('WGANTrainer.train_step_generator', self)
+        gen_loss = self.generator.train_step_generator(T21_small, T21_big, IC_delta, IC_vbv, self.generator_optimizer, self.critic)
+        self.generator_loss_metric.update_state(gen_loss)
+        return tf.cast(gen_loss, tf.float32)
+
+    def _train_cycle(self, iterator):
+        #
+        #Runs up to n_critic critic steps on consecutive batches of iterator and one generator step on the first batch,
+        #the same schedule as the i%n_critic == 0 check in the epoch loop, in a single graph (the loop becomes a tf.while_loop).
+        #Returns the number of batches consumed (fewer than n_critic means the iterator is exhausted),
+        #the critic loss and gradient penalty of every batch and the generator loss of the cycle.
+        #
+        count_trace('WGANTrainer.train_cycle', self)
+        steps = tf.constant(0)
+        critic_losses = tf.TensorArray(tf.float32, size=0, dynamic_size=True, element_shape=())
+        gradient_penalties = tf.TensorArray(tf.float32, size=0, dynamic_size=True, element_shape=())
+        generator_loss = tf.constant(0.)
+        for _ in tf.range(self.n_critic):
+            batch = iterator.get_next_as_optional()
+            if not batch.has_value():
+                break
+            T21_big, IC_delta, IC_vbv, T21_small = batch.get_value()
+
+            crit_loss, gp = self.train_step_critic(T21_big, IC_delta, IC_vbv, T21_small)
+            critic_losses = critic_losses.write(steps, crit_loss)
+            gradient_penalties = gradient_penalties.write(steps, gp)
+
+            if steps == 0:
+                generator_loss = self.train_step_generator(T21_big, IC_delta, IC_vbv, T21_small)
+            steps += 1
+        return steps, critic_losses.stack(), gradient_penalties.stack(), generator_loss
+
+    def reset_metrics(self):
+        self.critic_loss_metric.reset_state()
+        self.gradient_penalty_metric.reset_state()
+        self.generator_loss_metric.reset_state()
+
+    def stepwise_cycle(self, iterator, profiler=None):
+        #
+        #train_cycle stage by stage from python, one compiled call per step. Used while profiling (utils.profiling.Profiler):
+        #waiting on the input pipeline (which also orients and standardises the batches), the critic step and the generator
+        #step are timed separately, each synced with .numpy(). Also the train_cycle of a distributed trainer, tensorflow
+        #doesn't support the gradient all-reduce inside the loop and branch of the single graph. Same schedule and outputs.
+        #
+        timer = profiler.timer if profiler is not None else (lambda name: contextlib.nullcontext())
+        critic_losses, gradient_penalties, generator_loss = [], [], 0.
+        for steps in range(self.n_critic):
+            if profiler is not None:
+                profiler.step(int(self.critic_optimizer.iterations))
+            with timer('data_fetch'):
+                batch = iterator.get_next_as_optional() #agreed on by all workers of a distributed iterator
+                batch = batch.get_value() if batch.has_value() else None
+            if batch is None:
+                break
+            with timer('critic_step'):
+                crit_loss, gp = self.train_step_critic(*batch)
+                crit_loss, gp = crit_loss.numpy(), gp.numpy()
+            critic_losses.append(crit_loss)
+            gradient_penalties.append(gp)
+            if profiler is not None:
+                local_batches = self.strategy.experimental_local_results(batch[0]) if self.strategy is not None else [batch[0]]
+                profiler.count('samples', sum(x.shape[0] for x in local_batches))
+
+            if steps == 0:
+                with timer('generator_step'):
+                    generator_loss = self.train_step_generator(*batch).numpy()
+        steps = len(critic_losses)
+        return (tf.constant(steps), tf.constant(critic_losses, shape=(steps,), dtype=tf.float32),
+                tf.constant(gradient_penalties, shape=(steps,), dtype=tf.float32), tf.constant(generator_loss, dtype=tf.float32))
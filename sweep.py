@@ -0,0 +1,143 @@
+import argparse
+import itertools
+import os
+import time
+import tensorflow as tf
+from models.wgan import Generator, Critic, WGANTrainer, set_precision, log_trace_counts
+from utils.data_manager import DataManager
+from utils.metrics import MetricsLogger
+from utils.checkpointing import AsyncCheckpointer
+
+#Trains every (lambda, learning rate) combination of a hyperparameter sweep in one process, on one shared input pipeline:
+#python sweep.py --lbda 1 10 --learning_rate 1e-6 1e-5 --name sweep_1
+#Every batch is read, oriented and standardised once and then used for a train step of each configuration in turn, instead of
+#one GAN.py --index job per configuration that each repeat the I/O and preprocessing. Every configuration has its own
+#directory trained_models/<name>/lambda_<lbda>_lr_<learning_rate> with checkpoints and metrics.jsonl (as written by GAN.py),
+#and a sweep that is started again resumes each configuration from its latest checkpoint
+
+
+class SweepRun:
+    #generator, critic, optimizers and trainer of one configuration, with its checkpoints and metrics
+    def __init__(self, model_path, lbda, learning_rate, n_critic=10, vbv_channels=1, jit_compile=False, gp_interval=1,
+                 beta_1=0.5, beta_2=0.999, checkpoint_steps=None, box=128, critic_head='dense', loss_scaling=False):
+        self.lbda = lbda
+        self.learning_rate = learning_rate
+        self.model_path = model_path
+        os.makedirs(model_path, exist_ok=True)
+
+        self.generator = Generator(T21_shape=(1,box//2,box//2,box//2,1), delta_shape=(1,box,box,box,1), vbv_shape=(1,box,box,box,vbv_channels), jit_compile=jit_compile)
+        self.critic = Critic(lbda=lbda, jit_compile=jit_compile, gp_interval=gp_interval, head=critic_head)
+        #the critic scores the generator output, which is 2*generator.crop cells smaller than the box
+        min_box = self.critic.min_input_size() + 2*self.generator.crop
+        assert box >= min_box, "patch_size must be at least {0} (the critic needs {1} cells, the generator crops {2})".format(min_box + min_box % 2, self.critic.min_input_size(), 2*self.generator.crop)
+        self.generator_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2)
+        self.critic_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2)
+        if loss_scaling: #float16 precision, as in GAN.py
+            self.generator_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.generator_optimizer)
+            self.critic_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.critic_optimizer)
+        self.trainer = WGANTrainer(self.generator, self.critic, self.generator_optimizer, self.critic_optimizer, n_critic=n_critic, jit_compile=jit_compile)
+
+        #same checkpoint layout as GAN.py, so a configuration can be continued there (or emulated with generate.py)
+        self.epochs_done = tf.Variable(0, dtype=tf.int64, trainable=False)
+        ckpt = tf.train.Checkpoint(generator_model=self.generator.model, critic_model=self.critic.model,
+                                   generator_optimizer=self.generator_optimizer, critic_optimizer=self.critic_optimizer,
+                                   epochs_done=self.epochs_done)
+        manager = tf.train.CheckpointManager(ckpt, model_path+"/checkpoints", max_to_keep=5)
+        self.checkpointer = AsyncCheckpointer(manager, every_steps=checkpoint_steps)
+        restored = self.checkpointer.restore()
+        if restored is not None:
+            print("{0}: resuming from {1} after {2} epochs".format(self.name, restored, int(self.epochs_done)), flush=True)
+        self.metrics = MetricsLogger(model_path+"/metrics.jsonl")
+
+    @property
+    def name(self):
+        return "lambda={0}, learning rate={1}".format(self.lbda, self.learning_rate)
+
+    def train_step(self, e, i, batch, n_critic):
+        #critic step on every batch, generator step on the first batch of every n_critic, as in WGANTrainer.train_cycle
+        start = time.time()
+        crit_loss, gp = self.trainer.train_step_critic(*batch)
+        batch_losses = dict(critic_loss=crit_loss.numpy(), gradient_penalty=gp.numpy())
+        if i % n_critic == 0:
+            batch_losses['generator_loss'] = self.trainer.train_step_generator(*batch).numpy()
+        self.metrics.log('batch', epoch=e, batch=i, batch_time=time.time()-start, **batch_losses)
+        self.checkpointer.save(int(self.critic_optimizer.iterations))
+
+    def end_epoch(self, e, batches, train_time):
+        losses = dict(generator_loss=self.trainer.generator_loss_metric.result().numpy(), critic_loss=self.trainer.critic_loss_metric.result().numpy(),
+                      gradient_penalty=self.trainer.gradient_penalty_metric.result().numpy())
+        self.metrics.log('epoch', epoch=e, batches=batches, train_time=train_time, **losses)
+        self.epochs_done.assign(e + 1)
+        self.checkpointer.save(int(self.critic_optimizer.iterations), force=True)
+        self.metrics.flush()
+        print("{0}, epoch {1}: generator {2:.2f}, critic {3:.2f}, gradient penalty {4:.2f}, {5:.2f} sec".format(
+              self.name, e + 1, losses['generator_loss'], losses['critic_loss'], losses['gradient_penalty'], train_time), flush=True)
+
+    def close(self):
+        self.metrics.close()
+        self.checkpointer.sync()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep: train every (lambda, learning rate) combination on one shared dataset")
+    parser.add_argument('--path', type=str, default=os.getcwd(), help='Directory containing outputs/ and IC/')
+    parser.add_argument('--name', type=str, default='sweep', help='Configurations are written to trained_models/NAME/')
+    parser.add_argument('--lbda', type=float, nargs='+', default=[10.], help='Gradient penalty strengths')
+    parser.add_argument('--learning_rate', type=float, nargs='+', default=[1e-6], help='Learning rates (generator and critic)')
+    parser.add_argument('--epochs', type=int, default=200)
+    parser.add_argument('--n_critic', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--augments', type=int, default=10, help='Orientations per IC seed (and redshift) and epoch')
+    parser.add_argument('--seeds', type=int, nargs=2, default=[1000, 1008], help='Training IC seed range [start, stop)')
+    parser.add_argument('--redshifts', type=int, nargs='+', default=[10], help='Training redshifts, more than one trains redshift-conditioned models')
+    parser.add_argument('--workers', type=int, default=max(os.cpu_count()-1, 1), help='Data loader worker processes')
+    parser.add_argument('--checkpoint_steps', type=int, default=None, help='Also checkpoint every n train steps within an epoch')
+    parser.add_argument('--gp_interval', type=int, default=1, help='Lazy gradient penalty: computed every n-th critic step and scaled by n')
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16', 'float16'], help='Compute dtype of the models')
+    parser.add_argument('--cache_dtype', type=str, default='float32', choices=['float32', 'float16'], help='Storage dtype of the cached cubes')
+    parser.add_argument('--store', type=str, default=None, help='Read the cubes from this chunked HDF5 store (python -m utils.cube_store) instead of outputs/ and IC/')
+    parser.add_argument('--patch_size', type=int, default=None, help='Train on random aligned patch_size^3 sub-volumes instead of whole boxes (even, at least 32)')
+    parser.add_argument('--patches', type=int, default=8, help='Patches cut from every loaded box with --patch_size')
+    parser.add_argument('--critic_head', type=str, default='dense', choices=['dense', 'pool'], help="Critic output head, 'pool' (global average) scores any box or patch size")
+    parser.add_argument('--jit_compile', action='store_true', help='Compile the models and train steps with XLA')
+    args = parser.parse_args()
+
+    redshift_conditioning = len(args.redshifts) > 1
+    box = 128 if args.patch_size is None else args.patch_size
+    assert box % 2 == 0, "patch_size must be even, the low-res T21 is half the box"
+    set_precision(args.precision)
+
+    #one input pipeline for all configurations
+    Data = DataManager(args.path, redshifts=args.redshifts, IC_seeds=list(range(*args.seeds)), cache_dtype=args.cache_dtype, store=args.store)
+    dataset = Data.dataset(augments=args.augments, low_res=True, workers=args.workers, standardize=True,
+                           per_redshift=redshift_conditioning, condition=redshift_conditioning, patch_size=args.patch_size, patches=args.patches)
+    batches = dataset.batch(args.batch_size).prefetch(tf.data.AUTOTUNE)
+    print("Number of batches: ", len(batches), flush=True)
+
+    sweep_path = args.path + "/trained_models/" + args.name
+    runs = [SweepRun(sweep_path + "/lambda_{0}_lr_{1}".format(lbda, learning_rate), lbda, learning_rate, n_critic=args.n_critic,
+                     vbv_channels=1+redshift_conditioning, jit_compile=args.jit_compile, gp_interval=args.gp_interval,
+                     checkpoint_steps=args.checkpoint_steps, box=box, critic_head=args.critic_head, loss_scaling=args.precision == 'float16')
+            for lbda, learning_rate in itertools.product(args.lbda, args.learning_rate)]
+    print("Sweeping {0} configurations into {1}".format(len(runs), sweep_path), flush=True)
+
+    for e in range(min(int(run.epochs_done) for run in runs), args.epochs):
+        active = [run for run in runs if int(run.epochs_done) <= e] #configurations that were checkpointed further skip ahead
+        start = time.time()
+        train_time = {run.name: 0. for run in active}
+        for run in active:
+            run.trainer.reset_metrics()
+        n_batches = 0
+        for i, batch in enumerate(batches):
+            for run in active:
+                step_start = time.time()
+                run.train_step(e, i, batch, args.n_critic)
+                train_time[run.name] += time.time() - step_start
+            n_batches += 1
+        for run in active:
+            run.end_epoch(e, n_batches, train_time[run.name])
+        print("Time for epoch {0} of {1} configurations is {2:.2f} sec".format(e + 1, len(active), time.time() - start), flush=True)
+        log_trace_counts()
+
+    for run in runs:
+        run.close()
@@ -0,0 +1,37 @@
+import os
+import threading
+import numpy as np
+from scipy.io import loadmat
+from benchmarks.synthetic import write_synthetic_data
+from utils.cube_cache import CubeCache
+
+
+def test_concurrent_loads_of_uncached_cube(tmp_path):
+    #threads that miss on the same cube all convert it, none of them may fail or read a truncated copy
+    path = write_synthetic_data(str(tmp_path), box_size=16, IC_seeds=(1000,))
+    file = 'T21_cube_10_Npix16_L_x_y_1000_lin.mat'
+    expected = loadmat(path + '/outputs/' + file)['Tlin'].astype(np.float32)
+    cache = CubeCache(path)
+    errors, loads = [], []
+
+    def load(barrier):
+        barrier.wait()
+        try:
+            loads.append(np.array(cache.load('T21', file, 1000, 10)))
+            np.array(cache.load_stats(cache.stats_file_name('T21_lr', 1000, 10, 'stride', 2), lambda: np.ones((24,2))))
+        except Exception as e:
+            errors.append(e)
+
+    for _ in range(10):
+        for cache_file in os.listdir(cache.cache_dir):
+            os.remove(cache.cache_dir + '/' + cache_file)
+        barrier = threading.Barrier(4)
+        threads = [threading.Thread(target=load, args=(barrier,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    assert len(loads) == 40 and all(np.array_equal(x, expected) for x in loads)
+    assert not any(name.endswith('.tmp') for name in os.listdir(cache.cache_dir))
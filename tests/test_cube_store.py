@@ -0,0 +1,18 @@
+import numpy as np
+from benchmarks.synthetic import write_synthetic_data
+from utils.cube_store import CubeStore, convert
+from utils.symmetry import periodic_crop
+
+
+def test_read_periodic(tmp_path):
+    #sub-volume reads of the chunked store, wrapped around the box, match a crop of the whole cube
+    path = write_synthetic_data(str(tmp_path), box_size=16, IC_seeds=(1000, 1001), redshifts=(10, 11))
+    convert(path, path + '/cubes.h5', [1000, 1001], [10, 11], chunk=4)
+    store = CubeStore(path + '/cubes.h5')
+    assert store.IC_seeds == [1000, 1001] and store.redshifts == [10, 11] and store.shape() == (16, 16, 16)
+    for offset in [(0, 0, 0), (3, 14, 9), (15, 15, 15)]:
+        delta = store.read('delta', 1001)
+        assert np.array_equal(store.read_periodic('delta', 1001, offset, 6), periodic_crop(delta, offset, 6))
+        T21 = store.read('T21', 1001, [11, 10])
+        assert np.array_equal(store.read_periodic('T21', 1001, offset, 6, z=[11, 10]), periodic_crop(T21, offset, 6))
+    store.close()
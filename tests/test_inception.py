@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from models.wgan import Generator
+
+
+def generator(fused):
+    return Generator(T21_shape=(1,16,16,16,1), delta_shape=(1,32,32,32,1), vbv_shape=(1,32,32,32,1), fused_inception=fused)
+
+
+@pytest.mark.parametrize('saved_fused', [False, True])
+def test_fused_inception_checkpoints(saved_fused, tmp_path):
+    #a checkpoint of either layer restores into the other, with the same variables in the same order and the same output
+    saved, restored = generator(saved_fused), generator(not saved_fused)
+    path = tf.train.Checkpoint(generator_model=saved.model).save(str(tmp_path / 'ckpt'))
+    tf.train.Checkpoint(generator_model=restored.model).restore(path).assert_consumed()
+
+    assert [v.shape for v in saved.model.trainable_variables] == [v.shape for v in restored.model.trainable_variables]
+    assert all(np.array_equal(a, b) for a, b in zip(saved.model.get_weights(), restored.model.get_weights()))
+    rng = np.random.default_rng(0)
+    inputs = [rng.normal(size=shape).astype(np.float32) for shape in ((2,16,16,16,1), (2,32,32,32,1), (2,32,32,32,1))]
+    np.testing.assert_allclose(saved(*inputs).numpy(), restored(*inputs).numpy(), rtol=1e-4, atol=1e-5)
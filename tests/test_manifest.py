@@ -0,0 +1,31 @@
+import os
+import threading
+from benchmarks.synthetic import write_synthetic_data
+from utils.manifest import FileManifest
+
+
+def test_concurrent_manifest_builds(tmp_path):
+    #several DataManagers scanning and saving the manifest at once
+    path = write_synthetic_data(str(tmp_path), box_size=2, IC_seeds=range(1000, 1200), redshifts=range(10, 20))
+    errors, manifests = [], []
+
+    def build(barrier):
+        barrier.wait()
+        try:
+            manifests.append(FileManifest(path))
+        except Exception as e:
+            errors.append(e)
+
+    for _ in range(20):
+        if os.path.exists(path + '/cache/manifest.json'):
+            os.remove(path + '/cache/manifest.json')
+        barrier = threading.Barrier(8)
+        threads = [threading.Thread(target=build, args=(barrier,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    assert all(manifest.missing(range(1000, 1200), range(10, 20)) == [] for manifest in manifests)
+    assert os.listdir(path + '/cache') == ['manifest.json']
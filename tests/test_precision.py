@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from models.wgan import Generator, Critic, WGANTrainer, set_precision
+
+
+@pytest.fixture
+def restore_policy():
+    yield
+    set_precision('float32')
+
+
+@pytest.mark.parametrize('precision', ['bfloat16', 'float16'])
+def test_mixed_precision_train_steps(precision, restore_policy):
+    #one critic and one generator step on 32^3 boxes, with the loss scaling optimizers GAN.py uses for float16
+    set_precision(precision)
+    generator = Generator(T21_shape=(1,16,16,16,1), delta_shape=(1,32,32,32,1), vbv_shape=(1,32,32,32,1))
+    critic = Critic()
+    optimizers = [tf.keras.optimizers.Adam(1e-4), tf.keras.optimizers.Adam(1e-4)]
+    if precision == 'float16':
+        optimizers = [tf.keras.mixed_precision.LossScaleOptimizer(o) for o in optimizers]
+    trainer = WGANTrainer(generator, critic, *optimizers)
+    batch = [tf.random.normal((2,32,32,32,1)), tf.random.normal((2,32,32,32,1)), tf.random.normal((2,32,32,32,1)), tf.random.normal((2,16,16,16,1))]
+
+    critic_weights = [w.numpy().copy() for w in critic.model.trainable_variables]
+    generator_weights = [w.numpy().copy() for w in generator.model.trainable_variables]
+    critic_loss, gp = trainer.train_step_critic(*batch)
+    generator_loss = trainer.train_step_generator(*batch)
+
+    assert all(np.isfinite(x.numpy()) and x.dtype == tf.float32 for x in (critic_loss, gp, generator_loss))
+    assert any(not np.array_equal(w, v.numpy()) for w, v in zip(critic_weights, critic.model.trainable_variables))
+    assert any(not np.array_equal(w, v.numpy()) for w, v in zip(generator_weights, generator.model.trainable_variables))
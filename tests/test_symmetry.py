@@ -0,0 +1,62 @@
+import numpy as np
+import tensorflow as tf
+from utils.symmetry import orient, orient_tf, orient_stack, periodic_crop_tf, periodic_crop, stored_offset
+
+
+def augment_data(x):
+    #the 24 orientations as the original DataManager.augment_data wrote them out, 23 is the unaltered box
+    t = lambda perm: np.transpose(x, perm)
+    return [x[::-1, ::-1, :], x[::-1, :, ::-1], x[:, ::-1, ::-1],
+            t((1,0,2))[::-1, :, :], t((1,0,2))[::-1, :, ::-1], t((1,0,2))[:, ::-1, :], t((1,0,2))[:, ::-1, ::-1],
+            t((2,1,0))[::-1, :, :], t((2,1,0))[::-1, ::-1, :], t((2,1,0))[:, :, ::-1], t((2,1,0))[:, ::-1, ::-1],
+            t((0,2,1))[:, ::-1, :], t((0,2,1))[::-1, ::-1, :], t((0,2,1))[:, :, ::-1], t((0,2,1))[::-1, :, ::-1],
+            t((1,2,0))[::-1, ::-1, :], t((1,2,0))[:, ::-1, ::-1], t((1,2,0))[::-1, :, ::-1], t((1,2,0))[::-1, ::-1, ::-1],
+            t((2,0,1))[::-1, ::-1, :], t((2,0,1))[::-1, :, ::-1], t((2,0,1))[:, ::-1, ::-1], t((2,0,1))[::-1, ::-1, ::-1],
+            x]
+
+
+def test_orientations_match_augment_data():
+    x = np.arange(6**3, dtype=np.float32).reshape(6, 6, 6)
+    expected = augment_data(x)
+    assert len({y.tobytes() for y in expected}) == 24
+    for k in range(24):
+        assert np.array_equal(orient(x, k), expected[k])
+        assert np.array_equal(orient_tf(tf.constant(x), tf.constant(k)).numpy(), expected[k])
+    assert np.array_equal(orient_stack(x, [3, 23, 7]), np.stack([expected[3], expected[23], expected[7]]))
+
+
+def test_orient_batch_axes():
+    #axes=(1,2,3) orients every sample of a (batch,x,y,z,channels) array the same way
+    x = np.random.rand(2, 4, 4, 4, 3).astype(np.float32)
+    for k in range(24):
+        expected = np.stack([np.stack([augment_data(x[b,...,c])[k] for c in range(3)], axis=-1) for b in range(2)])
+        assert np.array_equal(orient(x, k, axes=(1,2,3)), expected)
+        assert np.array_equal(orient_tf(tf.constant(x), k, axes=(1,2,3)).numpy(), expected)
+
+
+def rolled_crop(x, offset, size, axes=(0,1,2)):
+    #reference periodic crop: roll the box so offset is at the origin and cut the corner
+    x = np.roll(x, [-o for o in offset], axis=axes)
+    return x[tuple(slice(0, size) if a in axes else slice(None) for a in range(x.ndim))]
+
+
+def test_periodic_crop_tf():
+    x = np.random.rand(8, 8, 8, 2).astype(np.float32)
+    for offset in [(0, 0, 0), (2, 5, 7), (7, 7, 7), (6, 0, 3)]:
+        assert np.array_equal(periodic_crop_tf(tf.constant(x), tf.constant(offset), 4).numpy(), rolled_crop(x, offset, 4))
+
+
+def test_periodic_crop():
+    x = np.random.rand(8, 8, 8).astype(np.float32)
+    for offset in [(0, 0, 0), (2, 5, 7), (7, 7, 7), (6, 0, 3)]:
+        assert np.array_equal(periodic_crop(x, offset, 4), rolled_crop(x, offset, 4))
+
+
+def test_stored_offset():
+    #a patch of the oriented box is the oriented patch of the unaltered box at stored_offset
+    x = np.random.rand(8, 8, 8).astype(np.float32)
+    for k in range(24):
+        for offset in [(0, 0, 0), (2, 5, 7), (6, 0, 3)]:
+            for size in (2, 4, 8):
+                patch = periodic_crop(orient(x, k), offset, size)
+                assert np.array_equal(orient(periodic_crop(x, stored_offset(k, offset, size, 8), size), k), patch)
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from models.wgan import Generator
+from models.tiling import TiledGenerator
+
+
+def generator(box):
+    return Generator(T21_shape=(1,box//2,box//2,box//2,1), delta_shape=(1,box,box,box,1), vbv_shape=(1,box,box,box,1))
+
+
+@pytest.mark.parametrize('box_size', [40, 34])
+def test_tiles_match_whole_box(box_size):
+    #tiles of a generator trained on 32^3 boxes stitch to one pass over the periodically padded box with the same weights.
+    #34 is covered by two 18 cell tiles, the last one wraps around and overlaps the first
+    tiled = TiledGenerator(generator(32), batch_size=3)
+    halo = tiled.halo
+    whole = generator(box_size + 2*halo)
+    whole.model.set_weights(tiled.generator.model.get_weights())
+
+    rng = np.random.default_rng(0)
+    T21_lr = rng.normal(size=(box_size//2,)*3 + (1,)).astype(np.float32)
+    delta, vbv = [rng.normal(size=(box_size,)*3 + (1,)).astype(np.float32) for _ in range(2)]
+    pad = lambda x, n: np.pad(x, [(n, n)]*3 + [(0, 0)], mode='wrap')[None]
+    expected = whole(pad(T21_lr, halo//2), pad(delta, halo), pad(vbv, halo)).numpy()[0]
+
+    starts, tile_size = tiled.tiles(box_size)
+    assert (len(starts), tile_size) == ((2, 20) if box_size == 40 else (2, 18))
+    np.testing.assert_allclose(tiled(T21_lr, delta, vbv), expected, rtol=1e-4, atol=1e-5)
+    outs = list(tiled.run([(T21_lr, delta, vbv, None)]*2, prefetch=2))
+    assert len(outs) == 2 and all(np.array_equal(out, outs[0]) for out in outs)
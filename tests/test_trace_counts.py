@@ -0,0 +1,33 @@
+import tensorflow as tf
+from models.wgan import jit_function, probe_tensors, count_trace, trace_counts, instance_ids
+
+
+class Traced:
+    def __init__(self):
+        self.instance_id = next(instance_ids)
+
+    def fn(self, x):
+        count_trace('Traced.fn', self)
+        return tf.numpy_function(lambda a: a * 2, [x], tf.float32) #not supported by XLA
+
+
+def traces(instance):
+    return sum(count for (name, instance_id, _), count in trace_counts.items() if name == 'Traced.fn' and instance_id == instance.instance_id)
+
+
+def test_xla_fallback_is_one_trace():
+    #the XLA probe fails and the graph function fallback is used, which must not show up as a retrace
+    traced = Traced()
+    signature = [tf.TensorSpec(shape=(None,), dtype=tf.float32)]
+    function = jit_function(traced.fn, signature, jit_compile=True, probe_args=probe_tensors(signature))
+    for n in (1, 3):
+        assert function(tf.ones(n)).numpy().tolist() == [2.]*n
+    assert traces(traced) == 1
+
+
+def test_instances_are_counted_separately():
+    signature = [tf.TensorSpec(shape=(None,), dtype=tf.float32)]
+    instances = [Traced(), Traced()]
+    for traced in instances:
+        tf.function(traced.fn, input_signature=signature)(tf.ones(2))
+    assert [traces(traced) for traced in instances] == [1, 1]
@@ -0,0 +1,21 @@
+import os
+import threading
+
+#Files are written under a temporary name next to their target and renamed into place, so an interrupted write never
+#leaves a truncated file behind. The temporary name is unique per process and thread: the tf.data threads, the loader
+#worker processes and several DataManagers can write the same file at once, and with a shared temporary name they would
+#truncate each other's file and all but one rename would fail
+
+
+def temp_name(file, suffix='.tmp'):
+    #suffix: ends the name, e.g. '.tmp.png' for writers that pick the format from the extension
+    return '{0}.{1}.{2}{3}'.format(file, os.getpid(), threading.get_ident(), suffix)
+
+
+def replace(tmp_file, file, overwrite=True):
+    #renames tmp_file to file. overwrite=False keeps a file another writer has put in place meanwhile (the same content
+    #computed twice) and discards tmp_file instead
+    if overwrite or not os.path.exists(file):
+        os.replace(tmp_file, file)
+    else:
+        os.remove(tmp_file)
@@ -0,0 +1,52 @@
+import os
+import time
+import tensorflow as tf
+
+
+class AsyncCheckpointer:
+    #Saves a tf.train.CheckpointManager every every_steps train steps and/or every_seconds of wall time (or only when
+    #save(force=True) is called if both are None). With async_save=True the variables are copied to host memory and
+    #written by a background thread (tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)), so the
+    #training loop only waits for the copy. The manager's 'checkpoint' state file is rewritten (atomically) only once
+    #a write has finished, and a checkpoint's .index file is the last file TF writes, so an interrupted save is never
+    #picked up by restore()
+    def __init__(self, manager, every_steps=None, every_seconds=None, async_save=True):
+        self.manager = manager
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.async_save = async_save
+        self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=async_save)
+        self.last_step = 0
+        self.last_time = time.time()
+
+    def due(self, step):
+        if (self.every_steps is not None) and (step - self.last_step >= self.every_steps):
+            return True
+        return (self.every_seconds is not None) and (time.time() - self.last_time >= self.every_seconds)
+
+    def save(self, step, force=False):
+        #returns the path of the checkpoint being written, or None if no save was due
+        if not (force or self.due(step)):
+            return None
+        self.last_step = step
+        self.last_time = time.time()
+        return self.manager.save(options=self.options)
+
+    def latest_complete(self):
+        #newest checkpoint whose files are all written
+        for checkpoint in reversed(self.manager.checkpoints):
+            if os.path.exists(checkpoint + '.index'):
+                return checkpoint
+        return None
+
+    def restore(self):
+        #restores the newest complete checkpoint, returns its path (None if there isn't one)
+        self.sync()
+        checkpoint = self.latest_complete()
+        if checkpoint is not None:
+            self.manager.checkpoint.restore(checkpoint)
+        return checkpoint
+
+    def sync(self):
+        #waits for the background write, e.g. before the process exits
+        self.manager.sync()
@@ -0,0 +1,119 @@
+import argparse
+import os
+import numpy as np
+from scipy.io import loadmat
+from utils.atomic import temp_name, replace
+from utils.degrade import degrade, add_noise
+
+
+class CubeCache:
+    #float32 .npy copies of the simulation cubes, keyed by IC seed (and redshift for T21).
+    #The .mat files are parsed once, after that every load is a np.memmap of the .npy file.
+    #dtype=np.float16 halves the disk space and page cache of the cubes, they are cast back to float32 when they are
+    #read into a sample. Each dtype has its own cache directory. The normalisation statistics are float64 either way.
+    #store: a utils.cube_store.CubeStore to read from instead of the .mat files. The store already is a compact copy with
+    #sub-volume reads, so load() reads whole cubes from it rather than writing .npy copies of them (only an explicit
+    #convert() or DataManager.build_cache does). The low-res levels and the statistics derived from them are still cached
+    mat_keys = {'T21': 'Tlin', 'delta': 'delta', 'vbv': 'vbv'}
+    source_dirs = {'T21': 'outputs', 'delta': 'IC', 'vbv': 'IC'}
+
+    def __init__(self, path, cache_dir=None, dtype=np.float32, store=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.store = store
+        if cache_dir is None:
+            cache_dir = path + '/cache' if self.dtype == np.float32 else path + '/cache_' + self.dtype.name
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def file_name(self, field, ID, z=None):
+        assert field in self.mat_keys, "field must be one of {0}".format(list(self.mat_keys))
+        if field == 'T21':
+            assert z is not None, "T21 cubes are keyed by seed and redshift"
+            return self.cache_dir + '/T21_cube_z{0}_ID{1}.npy'.format(int(z), int(ID))
+        return self.cache_dir + '/{0}_ID{1}.npy'.format(field, int(ID))
+
+    def source_name(self, field, file):
+        return self.path + '/' + self.source_dirs[field] + '/' + file
+
+    def is_cached(self, field, ID, z=None):
+        return os.path.exists(self.file_name(field, ID, z))
+
+    def lr_file_name(self, ID, z, mode, factor):
+        return self.cache_dir + '/T21_lr_{0}_x{1}_z{2}_ID{3}.npy'.format(mode, int(factor), int(z), int(ID))
+
+    def stats_file_name(self, field, ID, z=None, mode=None, factor=None):
+        if field == 'T21_lr':
+            return self.cache_dir + '/T21_lr_stats_{0}_x{1}_z{2}_ID{3}.npy'.format(mode, int(factor), int(z), int(ID))
+        return self.cache_dir + '/{0}_stats_ID{1}.npy'.format(field, int(ID))
+
+    def save(self, cache_file, cube, dtype=None, overwrite=False):
+        #write to a temporary file and rename, so an interrupted conversion never leaves a truncated cube behind (see utils/atomic.py).
+        #Concurrent loads of an uncached cube all convert it, the first one to finish puts its copy in place
+        tmp_file = temp_name(cache_file)
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.save(f, np.ascontiguousarray(cube, dtype=self.dtype if dtype is None else dtype))
+            replace(tmp_file, cache_file, overwrite)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def read_source(self, field, file, ID, z=None):
+        if self.store is not None:
+            return self.store.read(field, ID, z)
+        return loadmat(self.source_name(field, file))[self.mat_keys[field]]
+
+    def convert(self, field, file, ID, z=None, overwrite=False):
+        cache_file = self.file_name(field, ID, z)
+        if overwrite or not os.path.exists(cache_file):
+            self.save(cache_file, self.read_source(field, file, ID, z), overwrite=overwrite)
+        return cache_file
+
+    def convert_lr(self, file, ID, z, mode='average', factor=2, overwrite=False):
+        #low-res pyramid level of a T21 cube. 'noise' is stored as its average-pooled cube, the noise is drawn on every load
+        cached_mode = 'average' if mode == 'noise' else mode
+        cache_file = self.lr_file_name(ID, z, cached_mode, factor)
+        if overwrite or not os.path.exists(cache_file):
+            self.save(cache_file, degrade(self.load('T21', file, ID, z), factor=factor, mode=cached_mode), overwrite=overwrite)
+        return cache_file
+
+    def load(self, field, file, ID, z=None):
+        #read-only memmap, the data is only paged in when it is used
+        if not self.is_cached(field, ID, z):
+            if self.store is not None:
+                return self.store.read(field, ID, z)
+            assert file is not None, "{0} cube for ID={1} z={2} is neither cached nor on disk".format(field, ID, z)
+            self.convert(field, file, ID, z)
+        return np.load(self.file_name(field, ID, z), mmap_mode='r')
+
+    def load_lr(self, file, ID, z, mode='average', factor=2):
+        T21_lr = np.load(self.convert_lr(file, ID, z, mode, factor), mmap_mode='r')
+        if mode == 'noise':
+            T21_lr = add_noise(T21_lr, factor)
+        return T21_lr
+
+    def load_stats(self, cache_file, compute):
+        #float64 normalisation statistics, compute() is only called the first time
+        if not os.path.exists(cache_file):
+            self.save(cache_file, compute(), dtype=np.float64)
+        return np.load(cache_file)
+
+
+if __name__ == '__main__':
+    #one-time conversion: python -m utils.cube_cache --seeds 1000 1010 --redshifts 6 28
+    from utils.data_manager import DataManager
+
+    parser = argparse.ArgumentParser(description="Convert T21, delta and vbv .mat cubes to a memory-mapped .npy cache")
+    parser.add_argument('--path', type=str, default=os.getcwd(), help='Directory containing outputs/ and IC/')
+    parser.add_argument('--seeds', type=int, nargs=2, default=[1000, 1010], help='IC seed range [start, stop)')
+    parser.add_argument('--redshifts', type=int, nargs=2, default=[6, 28], help='Redshift range [start, stop)')
+    parser.add_argument('--overwrite', action='store_true', help='Reconvert cubes that are already cached')
+    parser.add_argument('--pyramid', action='store_true', help='Also cache the low-res T21 pyramid (average and gaussian, 2x and 4x)')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='Storage dtype of the cached cubes')
+    args = parser.parse_args()
+
+    Data = DataManager(args.path, redshifts=list(range(*args.redshifts)), IC_seeds=list(range(*args.seeds)), cache_dtype=args.dtype)
+    Data.build_cache(overwrite=args.overwrite)
+    if args.pyramid:
+        Data.build_pyramid(overwrite=args.overwrite)
@@ -0,0 +1,147 @@
+import argparse
+import os
+import h5py
+import numpy as np
+from scipy.io import loadmat
+from utils.cube_cache import CubeCache
+from utils.manifest import FileManifest
+
+
+class CubeStore:
+    #Chunked, compressed HDF5 copy of the simulation cubes in outputs/ and IC/, written by convert() below.
+    #One group per IC seed: /ID1000/T21 (len(redshifts),x,y,z) in chunks of (1,c,c,c), /ID1000/delta and /ID1000/vbv (x,y,z)
+    #in chunks of (c,c,c), and /redshifts. A read of a sub-volume or of some redshifts only reads and decompresses the chunks
+    #it touches. The file is opened on first use and again in every process, so a store can be shared with loader worker processes
+    def __init__(self, file):
+        self.file = file
+        self.handle = None
+        self.pid = None
+        self.metadata = None
+
+    @property
+    def h5(self):
+        if (self.handle is None) or (self.pid != os.getpid()):
+            self.handle = h5py.File(self.file, 'r')
+            self.pid = os.getpid()
+            self.metadata = None
+        return self.handle
+
+    def read_metadata(self):
+        #redshifts, complete seeds and box shape, read once per open handle: listing the seeds walks the attributes of every
+        #group, which would make each patch read slower the more seeds the store holds
+        h5 = self.h5
+        if self.metadata is None:
+            IC_seeds = sorted(int(name[2:]) for name, group in h5.items() if name.startswith('ID') and group.attrs.get('complete', False))
+            shape = h5['ID{0}/delta'.format(IC_seeds[0])].shape if len(IC_seeds) > 0 else None
+            self.metadata = ([int(z) for z in h5['redshifts'][:]], IC_seeds, shape)
+        return self.metadata
+
+    @property
+    def redshifts(self):
+        return self.read_metadata()[0]
+
+    @property
+    def IC_seeds(self):
+        #seeds whose conversion finished
+        return self.read_metadata()[1]
+
+    def shape(self):
+        #box shape (x,y,z), the same for every seed
+        shape = self.read_metadata()[2]
+        assert shape is not None, "{0} has no completely converted IC seed, run python -m utils.cube_store".format(self.file)
+        return shape
+
+    def missing(self, IC_seeds, redshifts):
+        #(field, IC seed, redshift) of the requested cubes that aren't in the store, as FileManifest.missing
+        stored_seeds, stored_redshifts = set(self.IC_seeds), set(self.redshifts)
+        missing = [(field, ID, None) for ID in IC_seeds if ID not in stored_seeds for field in ('delta', 'vbv')]
+        return missing + [('T21', ID, z) for ID in IC_seeds for z in redshifts if (ID not in stored_seeds) or (z not in stored_redshifts)]
+
+    def read(self, field, ID, z=None, region=None):
+        #field of IC seed ID. For T21, z is one redshift (an (x,y,z) cube as CubeCache.load returns) or a list of them
+        #(the redshifts as the last axis, as in DataManager.load_sample), None for all stored redshifts.
+        #region: (slice_x, slice_y, slice_z) of the box, the whole box by default
+        assert field in CubeCache.mat_keys, "field must be one of {0}".format(list(CubeCache.mat_keys))
+        region = tuple(region) if region is not None else (slice(None),)*3
+        dataset = self.h5['ID{0}/{1}'.format(int(ID), field)]
+        if field != 'T21':
+            return dataset[region]
+        redshifts = self.redshifts
+        if np.ndim(z) == 0 and z is not None:
+            return dataset[(redshifts.index(int(z)),) + region]
+        index = list(range(len(redshifts))) if z is None else [redshifts.index(int(z_)) for z_ in z]
+        stored = sorted(set(index)) #h5py reads a list of increasing indices
+        cubes = dataset[(stored,) + region]
+        return np.moveaxis(cubes[[stored.index(i) for i in index]], 0, -1)
+
+    def read_periodic(self, field, ID, offset, size, z=None):
+        #size^3 sub-volume starting at offset (3 ints), wrapped around the periodic box. At most 8 reads of plain sub-volumes
+        shape = self.shape()
+        assert all(size <= n for n in shape), "size must be at most the box size"
+        pieces = []
+        for o, n in zip(offset, shape):
+            o = int(o) % n
+            pieces.append([slice(o, min(o + size, n))] + ([slice(0, o + size - n)] if o + size > n else []))
+        return np.concatenate([np.concatenate([np.concatenate([self.read(field, ID, z, (x, y, z_)) for z_ in pieces[2]], axis=2)
+                                               for y in pieces[1]], axis=1) for x in pieces[0]], axis=0)
+
+    def close(self):
+        if self.handle is not None and self.pid == os.getpid():
+            self.handle.close()
+        self.handle = None
+        self.metadata = None
+
+
+def convert(path, file, IC_seeds, redshifts, chunk=32, compression='gzip', level=4, dtype=np.float32, overwrite=False):
+    #Writes the .mat cubes of IC_seeds and redshifts in path/outputs and path/IC to the store file. Seeds already in the store
+    #are skipped (unless overwrite), so an interrupted conversion continues where it stopped: a seed's group is only marked
+    #complete once all its cubes are written. compression: 'gzip' (with level, 0-9), 'lzf' (faster, less compact) or None.
+    #Both are lossless and used with the shuffle filter, which groups the bytes of the floats and compresses them better
+    manifest = FileManifest(path)
+    missing = manifest.missing(IC_seeds, redshifts)
+    assert len(missing) == 0, "Missing files (field, IC seed, redshift): {0}".format(missing)
+    options = dict(compression=compression, compression_opts=level if compression == 'gzip' else None, shuffle=compression is not None)
+
+    with h5py.File(file, 'a') as f:
+        if 'redshifts' not in f:
+            f.create_dataset('redshifts', data=np.array(redshifts))
+        assert list(f['redshifts'][:]) == list(redshifts), "{0} was written for redshifts {1}".format(file, list(f['redshifts'][:]))
+        for n, ID in enumerate(IC_seeds):
+            name = 'ID{0}'.format(ID)
+            if name in f and f[name].attrs.get('complete', False) and not overwrite:
+                continue
+            if name in f:
+                del f[name]
+            group = f.create_group(name)
+            for field, source in (('delta', manifest.delta_file(ID)), ('vbv', manifest.vbv_file(ID))):
+                cube = loadmat(path + '/' + CubeCache.source_dirs[field] + '/' + source)[CubeCache.mat_keys[field]]
+                group.create_dataset(field, data=cube.astype(dtype), chunks=tuple(min(chunk, s) for s in cube.shape), **options)
+            T21 = None
+            for j, z in enumerate(redshifts):
+                cube = loadmat(path + '/outputs/' + manifest.T21_file(ID, z))[CubeCache.mat_keys['T21']]
+                if T21 is None:
+                    T21 = group.create_dataset('T21', shape=(len(redshifts), *cube.shape), dtype=dtype,
+                                               chunks=(1, *(min(chunk, s) for s in cube.shape)), **options)
+                T21[j] = cube
+            group.attrs['complete'] = True
+            f.flush()
+            print("Stored IC seed {0} ({1}/{2})".format(ID, n+1, len(IC_seeds)), flush=True)
+
+
+if __name__ == '__main__':
+    #one-time conversion: python -m utils.cube_store --seeds 1000 1010 --redshifts 6 28
+    parser = argparse.ArgumentParser(description="Convert the T21, delta and vbv .mat cubes to a chunked, compressed HDF5 store")
+    parser.add_argument('--path', type=str, default=os.getcwd(), help='Directory containing outputs/ and IC/')
+    parser.add_argument('--output', type=str, default=None, help='Store file, path/cubes.h5 by default')
+    parser.add_argument('--seeds', type=int, nargs=2, default=[1000, 1010], help='IC seed range [start, stop)')
+    parser.add_argument('--redshifts', type=int, nargs=2, default=[6, 28], help='Redshift range [start, stop)')
+    parser.add_argument('--chunk', type=int, default=32, help='Chunk edge length in cells')
+    parser.add_argument('--compression', type=str, default='gzip', choices=['gzip', 'lzf', 'none'])
+    parser.add_argument('--level', type=int, default=4, help='gzip level (0-9)')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='Storage dtype of the cubes')
+    parser.add_argument('--overwrite', action='store_true', help='Convert seeds that are already in the store again')
+    args = parser.parse_args()
+
+    output = args.output if args.output is not None else args.path + '/cubes.h5'
+    convert(args.path, output, list(range(*args.seeds)), list(range(*args.redshifts)), chunk=args.chunk,
+            compression=None if args.compression == 'none' else args.compression, level=args.level, dtype=args.dtype, overwrite=args.overwrite)
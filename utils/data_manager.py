@@ -0,0 +1,375 @@
+import numpy as np
+import tensorflow as tf
+from scipy.io import loadmat
+from utils.cube_cache import CubeCache
+from utils.cube_store import CubeStore
+from utils.manifest import FileManifest
+from utils.symmetry import orient, orient_stack, orient_tf, stride_offsets, periodic_crop_tf, periodic_crop, stored_offset
+from utils.degrade import degrade
+from utils.parallel_loader import ParallelCubeLoader
+from utils.normalization import standardize_with, append_redshift
+
+
+class DataManager:
+    def __init__(self, path, redshifts=[16], IC_seeds=[1000,1001], cache=True, cache_dtype=np.float32, store=None):
+        self.path = path
+        self.redshifts = redshifts
+        self.IC_seeds = IC_seeds
+        #store: file of a chunked HDF5 store (utils/cube_store.py), read instead of outputs/ and IC/ (which then needn't exist).
+        #Patches (dataset(patch_size=...)) are read from it directly, without loading the whole boxes. The cache then only
+        #holds the low-res levels and statistics, whole cubes are read from the store and not copied (unless build_cache is called)
+        self.store = CubeStore(store) if store is not None else None
+        #cache=True: cubes are converted to .npy (cache_dtype, float32 or float16) once and memory-mapped afterwards instead of parsing the .mat files on every load
+        self.cache = CubeCache(path, dtype=cache_dtype, store=self.store) if cache else None
+        self.manifest = FileManifest(path) if store is None else None
+
+    def get_file_lists(self):
+        assert isinstance(self.redshifts, list), "redshifts must be a list"
+        assert isinstance(self.IC_seeds, list), "IC_seeds must be a list"
+        if self.store is not None:
+            #cubes are looked up by seed and redshift in the store, there are no file names
+            missing = self.store.missing(self.IC_seeds, self.redshifts)
+            assert len(missing) == 0, "Missing in {0} (field, IC seed, redshift): {1}".format(self.store.file, missing)
+            return np.full((len(self.IC_seeds), len(self.redshifts)), None, dtype=object), np.full(len(self.IC_seeds), None, dtype=object), np.full(len(self.IC_seeds), None, dtype=object)
+        self.manifest.refresh()
+        missing = self.manifest.missing(self.IC_seeds, self.redshifts)
+        assert len(missing) == 0, "Missing files (field, IC seed, redshift): {0}".format(missing)
+
+        T21_files = np.empty(shape=(len(self.IC_seeds), len(self.redshifts)), dtype=object)
+        delta_files = np.empty(shape=(len(self.IC_seeds)), dtype=object)
+        vbv_files = np.empty(shape=(len(self.IC_seeds)), dtype=object)
+        for i,ID in enumerate(self.IC_seeds):
+            delta_files[i] = self.manifest.delta_file(ID)
+            vbv_files[i] = self.manifest.vbv_file(ID)
+            for j,z in enumerate(self.redshifts):
+                T21_files[i,j] = self.manifest.T21_file(ID, z)
+        
+        return T21_files, delta_files, vbv_files
+
+    def load_cube(self, field, file, ID, z=None):
+        if self.cache is not None:
+            return self.cache.load(field, file, ID, z)
+        if self.store is not None:
+            return self.store.read(field, ID, z)
+        return loadmat(self.path + '/' + CubeCache.source_dirs[field] + '/' + file)[CubeCache.mat_keys[field]]
+
+    def build_cache(self, overwrite=False):
+        #one-time conversion of all requested seeds and redshifts, later loads are memmaps
+        assert self.cache is not None, "build_cache requires cache=True"
+        T21_files, delta_files, vbv_files = self.get_file_lists()
+        for i,ID in enumerate(self.IC_seeds):
+            self.cache.convert('delta', delta_files[i], ID, overwrite=overwrite)
+            self.cache.convert('vbv', vbv_files[i], ID, overwrite=overwrite)
+            for j,z in enumerate(self.redshifts):
+                self.cache.convert('T21', T21_files[i,j], ID, z, overwrite=overwrite)
+            print("Cached IC seed {0} ({1}/{2})".format(ID, i+1, len(self.IC_seeds)), flush=True)
+
+    def load_lr(self, file, ID, z, mode='average', factor=2):
+        #low-res T21 cube, from the cached pyramid when cache=True
+        if self.cache is not None:
+            return self.cache.load_lr(file, ID, z, mode, factor)
+        return degrade(self.load_cube('T21', file, ID, z), factor=factor, mode=mode)
+
+    def build_pyramid(self, factors=(2,4), modes=('average','gaussian'), overwrite=False):
+        #low-res T21 of every seed and redshift, computed once and cached next to the high-res cubes.
+        #'stride' is a slice and needs no cache, 'noise' is drawn on top of the 'average' level
+        assert self.cache is not None, "build_pyramid requires cache=True"
+        T21_files, delta_files, vbv_files = self.get_file_lists()
+        for i,ID in enumerate(self.IC_seeds):
+            for j,z in enumerate(self.redshifts):
+                for mode in modes:
+                    for factor in factors:
+                        self.cache.convert_lr(T21_files[i,j], ID, z, mode=mode, factor=factor, overwrite=overwrite)
+            print("Cached low-res pyramid for IC seed {0} ({1}/{2})".format(ID, i+1, len(self.IC_seeds)), flush=True)
+    
+    def generator_func(self, augment=False, augments=24, low_res=False, low_res_mode='average', factor=2):
+        assert len(self.redshifts) == 1, "generator_func only works for one redshift at a time"
+        low_res_mode = low_res_mode.decode() if isinstance(low_res_mode, bytes) else low_res_mode #tf.data.Dataset.from_generator passes args as bytes
+        T21_files, delta_files, vbv_files = self.get_file_lists()
+        #print(T21_files,augments)
+        if augment:
+            augs = np.array([np.random.choice(24, size=augments, replace=False) for i in range(len(delta_files))]) #might need shuffling 
+            #print(augs)
+            #k=0
+            for i in range(augments):
+                #print("test: ", augs[:,i])
+                #print("test2: ", T21_files[0],delta_files,vbv_files,augs[:,i])
+                for j,(T21_file, delta_file, vbv_file, aug) in enumerate(zip(T21_files,delta_files,vbv_files,augs[:,i])):
+                    #k+=1
+                    #print(T21_file[0].split('_')[7], delta_file.split("delta")[1].split(".")[0], vbv_file.split("vbv")[1].split(".")[0], aug)
+                    #print("j={0}, k={1}".format(j,k))
+                    T21 = self.load_cube('T21', T21_file[0], self.IC_seeds[j], self.redshifts[0])
+                    delta = self.load_cube('delta', delta_file, self.IC_seeds[j])
+                    vbv = self.load_cube('vbv', vbv_file, self.IC_seeds[j])
+
+                    T21 = self.augment_data(T21, augments=aug).reshape(1,128,128,128,1)
+                    delta = self.augment_data(delta, augments=aug).reshape(1,128,128,128,1)
+                    vbv = self.augment_data(vbv, augments=aug).reshape(1,128,128,128,1)
+                    if low_res:
+                        #low-res of the base cube, oriented like the high-res one ('noise' and 'average' commute with the orientations)
+                        T21_lr = self.augment_data(self.load_lr(T21_file[0], self.IC_seeds[j], self.redshifts[0], mode=low_res_mode, factor=factor), augments=aug)
+                    else:
+                        T21_lr = T21[:,:128//factor,:128//factor,:128//factor,:]
+                    
+                    
+                    T21 = tf.cast(tf.reshape(T21, (128,128,128,1)), dtype=tf.float32)
+                    delta = tf.cast(tf.reshape(delta, (128,128,128,1)), dtype=tf.float32)
+                    vbv = tf.cast(tf.reshape(vbv, (128,128,128,1)), dtype=tf.float32)
+                    T21_lr = tf.cast(tf.reshape(T21_lr, (128//factor,128//factor,128//factor,1)), dtype=tf.float32)
+                    yield T21, delta, vbv, T21_lr
+        else:
+            for j,(T21_file, delta_file, vbv_file) in enumerate(zip(T21_files,delta_files,vbv_files)):
+                T21 = self.load_cube('T21', T21_file[0], self.IC_seeds[j], self.redshifts[0])
+                delta = self.load_cube('delta', delta_file, self.IC_seeds[j])
+                vbv = self.load_cube('vbv', vbv_file, self.IC_seeds[j])
+                T21_lr = T21[:64,:64,:64]
+                
+                T21_lr = tf.cast(tf.reshape(T21_lr, (64,64,64,1)), dtype=tf.float32)
+                T21 = tf.cast(tf.reshape(T21, (128,128,128,1)), dtype=tf.float32)
+                delta = tf.cast(tf.reshape(delta, (128,128,128,1)), dtype=tf.float32)
+                vbv = tf.cast(tf.reshape(vbv, (128,128,128,1)), dtype=tf.float32)
+                print(j, T21.shape, delta.shape, vbv.shape, T21_lr.shape)
+                yield T21, delta, vbv, T21_lr
+            
+    
+        
+
+
+    def load(self):
+        T21_files, delta_files, vbv_files = self.get_file_lists()
+        T21 = np.zeros((len(self.IC_seeds), 128, 128, 128, len(self.redshifts)), dtype=np.float32)
+        delta = np.zeros((len(self.IC_seeds), 128, 128, 128), dtype=np.float32)
+        vbv = np.zeros((len(self.IC_seeds), 128, 128, 128), dtype=np.float32)
+        for i,file in enumerate(T21_files):
+            delta[i] = self.load_cube('delta', delta_files[i], self.IC_seeds[i])
+            vbv[i] = self.load_cube('vbv', vbv_files[i], self.IC_seeds[i])
+            for j,file_ in enumerate(file):
+                T21[i,:,:,:,j] = self.load_cube('T21', file_, self.IC_seeds[i], self.redshifts[j])
+        return T21, delta, vbv
+    
+    def data(self, augment=False, augments=23, low_res=False, low_res_mode='stride', factor=2):
+        #augments: number of augmented data per IC seed. Always includes the unaltered box
+        T21, delta, vbv = self.load()
+        if augment:
+            assert (augments <= 23) and (augments>=1), "augments must be between 1 and 23"
+            delta_augmented = np.empty(((augments+1)*len(self.IC_seeds), 128, 128, 128), dtype=np.float32)
+            vbv_augmented = np.empty(((augments+1)*len(self.IC_seeds), 128, 128, 128), dtype=np.float32)
+            T21_augmented = np.empty(((augments+1)*len(self.IC_seeds), 128, 128, 128, len(self.redshifts)), dtype=np.float32)
+
+            for i in range(len(self.IC_seeds)):
+                augs = [*np.random.choice(23, size=augments, replace=True), 23]
+                for a,k in enumerate(augs):
+                    delta_augmented[i*(augments+1)+a] = orient(delta[i], k)
+                    vbv_augmented[i*(augments+1)+a] = orient(vbv[i], k)
+                    T21_augmented[i*(augments+1)+a] = orient(T21[i], k) #all redshifts at once
+            T21 = tf.cast(T21_augmented, dtype=tf.float32)
+            delta = tf.expand_dims(input=tf.cast(delta_augmented, dtype=tf.float32), axis=4)
+            vbv = tf.expand_dims(input=tf.cast(vbv_augmented, dtype=tf.float32), axis=4)
+        else:
+            T21 = tf.cast(T21, dtype=tf.float32)
+            delta = tf.expand_dims(input=tf.cast(delta, dtype=tf.float32), axis=4)
+            vbv = tf.expand_dims(input=tf.cast(vbv, dtype=tf.float32), axis=4)
+
+        if low_res:
+            #one vectorised degradation of all samples and redshifts, see utils/degrade.py for the modes
+            T21_lr = tf.cast(degrade(T21.numpy(), factor=factor, mode=low_res_mode, axes=(1,2,3)), dtype=tf.float32)
+        else:
+            T21_lr = None
+        return T21, delta, vbv, T21_lr
+
+    def redshift_indices(self, j=-1):
+        #redshift index j, or all redshifts for j=-1
+        j = int(j)
+        return list(range(len(self.redshifts))) if j < 0 else [j]
+
+    def load_sample(self, i, j=-1):
+        #base (unaugmented) cubes of IC seed index i and redshift index j (all redshifts as channels for j=-1), read from the memmapped cache
+        i = int(i)
+        ID = self.IC_seeds[i]
+        T21 = np.stack([self.load_cube('T21', self.T21_files[i,j], ID, self.redshifts[j]) for j in self.redshift_indices(j)], axis=-1).astype(np.float32)
+        delta = np.asarray(self.load_cube('delta', self.delta_files[i], ID), dtype=np.float32)[...,None]
+        vbv = np.asarray(self.load_cube('vbv', self.vbv_files[i], ID), dtype=np.float32)[...,None]
+        return T21, delta, vbv
+
+    def load_lr_sample(self, i, mode, factor, j=-1):
+        #cached low-res T21 of IC seed index i and redshift index j (all redshifts for j=-1)
+        i = int(i)
+        return np.stack([self.load_lr(self.T21_files[i,j], self.IC_seeds[i], self.redshifts[j], mode=mode, factor=factor) for j in self.redshift_indices(j)], axis=-1).astype(np.float32)
+
+    def load_patches(self, i, j, k, offsets, patch_size, mode, factor):
+        #(T21, delta, vbv, T21_lr) patches of IC seed index i and redshift index j in orientation k, stacked along a new first axis,
+        #as periodic crops at offsets (patches,3) of the oriented boxes would give them. Read from the store: each patch is read at
+        #the matching corner of the unaltered box (see stored_offset) and then oriented, so only the chunks under it are decompressed
+        i, k = int(i), int(k)
+        ID = self.IC_seeds[i]
+        redshifts = [self.redshifts[j_] for j_ in self.redshift_indices(j)]
+        n = self.store.shape()[0]
+        patches = [[], [], [], []]
+        for offset in offsets:
+            stored = stored_offset(k, offset, patch_size, n)
+            T21 = orient(self.store.read_periodic('T21', ID, stored, patch_size, z=redshifts), k)
+            patches[0].append(T21)
+            patches[1].append(orient(self.store.read_periodic('delta', ID, stored, patch_size), k)[...,None])
+            patches[2].append(orient(self.store.read_periodic('vbv', ID, stored, patch_size), k)[...,None])
+            if mode == 'stride':
+                patches[3].append(T21[::factor, ::factor, ::factor])
+            else:
+                #crop of the (memmapped) pyramid level at the low-res corner, which lines up as offsets are multiples of factor
+                T21_lr = [periodic_crop(self.load_lr(self.T21_files[i,j_], ID, self.redshifts[j_], mode=mode, factor=factor), [o//factor for o in stored], patch_size//factor)
+                          for j_ in self.redshift_indices(j)]
+                patches[3].append(orient(np.stack(T21_lr, axis=-1), k))
+        return [np.stack(x).astype(np.float32) for x in patches]
+
+    def lr_stats(self, i, j, mode='stride', factor=2):
+        #(24,2) mean and var of the low-res T21 of seed index i and redshift index j in each orientation, as dataset() produces it.
+        #'stride' slices the oriented cube, so a flipped axis starts from the last cell and the stats depend on the orientation.
+        #The other modes orient a cached level, which doesn't change the stats ('noise' uses the noise-free level)
+        ID, z = self.IC_seeds[i], self.redshifts[j]
+        def compute():
+            if mode != 'stride':
+                x = self.load_lr(self.T21_files[i,j], ID, z, mode='average' if mode == 'noise' else mode, factor=factor)
+                return np.tile([np.mean(x, dtype=np.float64), np.var(x, dtype=np.float64)], (24,1))
+            T21 = self.load_cube('T21', self.T21_files[i,j], ID, z)
+            stats = {}
+            for k in range(24):
+                offsets = stride_offsets(k, T21.shape, factor)
+                if offsets not in stats:
+                    x = T21[offsets[0]::factor, offsets[1]::factor, offsets[2]::factor]
+                    stats[offsets] = [np.mean(x, dtype=np.float64), np.var(x, dtype=np.float64)]
+            return np.array([stats[stride_offsets(k, T21.shape, factor)] for k in range(24)])
+        if self.cache is None:
+            return compute()
+        return self.cache.load_stats(self.cache.stats_file_name('T21_lr', ID, z, mode, factor), compute)
+
+    def vbv_stats(self, i):
+        #(2,) mean and var of the vbv cube of seed index i, the same in every orientation
+        ID = self.IC_seeds[i]
+        def compute():
+            x = self.load_cube('vbv', self.vbv_files[i], ID)
+            return np.array([np.mean(x, dtype=np.float64), np.var(x, dtype=np.float64)])
+        if self.cache is None:
+            return compute()
+        return self.cache.load_stats(self.cache.stats_file_name('vbv', ID), compute)
+
+    def sample_stats(self, i, mode, factor, j=-1):
+        i = int(i)
+        lr_stats = np.stack([self.lr_stats(i, j, mode, factor) for j in self.redshift_indices(j)], axis=1)
+        return lr_stats.astype(np.float32), self.vbv_stats(i).astype(np.float32)
+
+    def dataset(self, augments=24, low_res=True, shuffle=True, low_res_mode='stride', factor=2, workers=0, standardize=False,
+                per_redshift=False, condition=False, shards=1, shard_index=0, patch_size=None, patches=1):
+        #lazy alternative to data(augment=True): only the base cubes are kept (as memmaps when cache=True),
+        #the dataset holds (seed index, orientation) pairs and the orientation is applied on the fly in the tf.data graph.
+        #augments: number of orientations per IC seed (1-24). Always includes the unaltered box
+        #low_res_mode='stride' slices the oriented cube in the graph, the other modes orient the cached pyramid level.
+        #This is exact for 'average' and 'noise'. For 'gaussian' a flipped axis samples the other parity of cells
+        #workers>0: the cubes are decoded in that many worker processes (utils/parallel_loader.py) and interleaved,
+        #otherwise they are read with tf.numpy_function on the tf.data threads
+        #standardize=True: T21 and T21_lr are standardised with the low-res statistics and vbv with its own, as in GAN.py,
+        #using the cached per (seed, redshift, orientation) statistics instead of moments of every batch
+        #per_redshift=True: every (seed, redshift, orientation) is a separate sample with one T21 channel, streamed from the
+        #per redshift cache files, instead of one sample per (seed, orientation) with all redshifts as channels.
+        #Only the cubes of the samples in flight are in memory, however many redshifts there are
+        #condition=True: the redshift of the sample is appended to vbv as a constant channel (see append_redshift),
+        #for a Generator with vbv_shape[-1]=2 that covers several redshifts
+        #shards, shard_index: only every shards-th sample, for one input pipeline of a distributed run (utils/distribute.py).
+        #The shards are disjoint and have the same size (up to shards-1 samples are dropped), so all workers run the same number of steps
+        #patch_size: instead of the whole box, every sample yields patches random patch_size^3 sub-volumes of the oriented and
+        #standardised cubes, at the same offsets in T21, delta and vbv and at the matching half offsets (patch_size/factor)^3 in T21_lr.
+        #Offsets are multiples of factor so the low-res cells line up, and patches wrap around the periodic box
+        assert (augments <= 24) and (augments >= 1), "augments must be between 1 and 24"
+        assert (patch_size is None) or (patch_size % factor == 0), "patch_size must be a multiple of factor"
+        assert per_redshift or (not condition) or len(self.redshifts) == 1, "condition=True needs per_redshift=True or a single redshift"
+        self.T21_files, self.delta_files, self.vbv_files = self.get_file_lists()
+        shape = self.store.shape() if self.store is not None else self.load_cube('delta', self.delta_files[0], self.IC_seeds[0]).shape
+        n_z = 1 if per_redshift else len(self.redshifts)
+        redshifts = tf.constant(self.redshifts, dtype=tf.float32)
+
+        seed_index = np.repeat(np.arange(len(self.IC_seeds)), augments)
+        orientation = np.concatenate([[*np.random.choice(23, size=augments-1, replace=False), 23] for i in range(len(self.IC_seeds))]).astype(np.int32)
+        if per_redshift:
+            #new random orientations for every redshift of a seed
+            redshift_index = np.repeat(np.arange(len(self.redshifts)), len(seed_index))
+            seed_index = np.tile(seed_index, len(self.redshifts))
+            orientation = np.concatenate([np.concatenate([[*np.random.choice(23, size=augments-1, replace=False), 23] for i in range(len(self.IC_seeds))])
+                                          for j in range(len(self.redshifts))]).astype(np.int32)
+        else:
+            redshift_index = np.full(len(seed_index), -1)
+        if shards > 1:
+            keep = (len(seed_index) // shards) * shards
+            seed_index, redshift_index, orientation = [x[shard_index:keep:shards] for x in (seed_index, redshift_index, orientation)]
+        dataset = tf.data.Dataset.from_tensor_slices((seed_index, redshift_index, orientation))
+        n_samples = len(seed_index)
+        if shuffle:
+            dataset = dataset.shuffle(n_samples, reshuffle_each_iteration=True)
+
+        def orient_sample(i, j, k, T21, delta, vbv):
+            T21 = orient_tf(T21, k)
+            delta = orient_tf(delta, k)
+            vbv = orient_tf(vbv, k)
+            lr_shape = (shape[0]//factor, shape[1]//factor, shape[2]//factor, n_z)
+            if low_res and low_res_mode == 'stride':
+                T21_lr = T21[::factor, ::factor, ::factor, :]
+            elif low_res:
+                T21_lr = tf.numpy_function(lambda i, j: self.load_lr_sample(i, low_res_mode, factor, j), [i, j], tf.float32)
+                T21_lr = orient_tf(tf.ensure_shape(T21_lr, lr_shape), k)
+            else:
+                T21_lr = T21[:lr_shape[0], :lr_shape[1], :lr_shape[2], :]
+            return i, j, k, T21, delta, vbv, T21_lr
+
+        def finish_sample(i, j, k, T21, delta, vbv, T21_lr):
+            #standardisation and conditioning of an oriented sample, or of a stack of its patches
+            if standardize:
+                lr_stats, vbv_stats = tf.numpy_function(lambda i, j: self.sample_stats(i, low_res_mode, factor, j), [i, j], [tf.float32, tf.float32])
+                lr_stats = tf.gather(tf.ensure_shape(lr_stats, (24, n_z, 2)), k)
+                T21 = standardize_with(T21, lr_stats[:,0], lr_stats[:,1])
+                T21_lr = standardize_with(T21_lr, lr_stats[:,0], lr_stats[:,1])
+                vbv_stats = tf.ensure_shape(vbv_stats, (2,))
+                vbv = standardize_with(vbv, vbv_stats[0], vbv_stats[1])
+            if condition:
+                vbv = append_redshift(vbv, tf.gather(redshifts, tf.maximum(j, 0)))
+            return T21, delta, vbv, T21_lr
+
+        if (self.store is not None) and (patch_size is not None):
+            #the patches are read from the store on the tf.data threads (workers isn't used), only the chunks under them are decompressed
+            patch_shape = (patches, patch_size, patch_size, patch_size)
+            def load(i, j, k):
+                offsets = factor * tf.random.uniform((patches, 3), 0, shape[0]//factor, dtype=tf.int32)
+                T21, delta, vbv, T21_lr = tf.numpy_function(lambda i, j, k, offsets: self.load_patches(i, j, k, offsets, patch_size, low_res_mode if low_res else 'stride', factor),
+                                                            [i, j, k, offsets], [tf.float32]*4)
+                return (i, j, k, tf.ensure_shape(T21, (*patch_shape, n_z)), tf.ensure_shape(delta, (*patch_shape, 1)), tf.ensure_shape(vbv, (*patch_shape, 1)),
+                        tf.ensure_shape(T21_lr, (patches, patch_size//factor, patch_size//factor, patch_size//factor, n_z)))
+            dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE).map(finish_sample, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+        else:
+            if workers > 0:
+                self.loader = ParallelCubeLoader(self, workers=workers)
+                output_signature = (tf.TensorSpec(shape=(*shape, n_z), dtype=tf.float32),
+                                    tf.TensorSpec(shape=(*shape, 1), dtype=tf.float32),
+                                    tf.TensorSpec(shape=(*shape, 1), dtype=tf.float32))
+                def load(i, j, k):
+                    cubes = tf.data.Dataset.from_generator(self.loader.generate, args=(i, j), output_signature=output_signature)
+                    return cubes.map(lambda T21, delta, vbv: (i, j, k, T21, delta, vbv))
+                dataset = dataset.interleave(load, cycle_length=workers, block_length=1, num_parallel_calls=workers, deterministic=False)
+            else:
+                def load(i, j, k):
+                    T21, delta, vbv = tf.numpy_function(self.load_sample, [i, j], [tf.float32, tf.float32, tf.float32])
+                    return i, j, k, tf.ensure_shape(T21, (*shape, n_z)), tf.ensure_shape(delta, (*shape, 1)), tf.ensure_shape(vbv, (*shape, 1))
+                dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+            dataset = dataset.map(orient_sample, num_parallel_calls=tf.data.AUTOTUNE).map(finish_sample, num_parallel_calls=tf.data.AUTOTUNE)
+
+            if patch_size is not None:
+                def crop_patches(T21, delta, vbv, T21_lr):
+                    offsets = factor * tf.random.uniform((patches, 3), 0, shape[0]//factor, dtype=tf.int32)
+                    crop = lambda x, size, scale=1: tf.stack([periodic_crop_tf(x, offsets[n]//scale, size) for n in range(patches)])
+                    return crop(T21, patch_size), crop(delta, patch_size), crop(vbv, patch_size), crop(T21_lr, patch_size//factor, factor)
+                dataset = dataset.map(crop_patches, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+        if patch_size is not None:
+            n_samples *= patches
+            if shuffle and patches > 1:
+                dataset = dataset.shuffle(4*patches) #mixes the patches of a few boxes, which come out one box after another
+        #the interleave loses the number of samples, len() of the dataset (and its batches) needs it
+        return dataset.apply(tf.data.experimental.assert_cardinality(n_samples))
+
+    def augment_data(self, x, augments=23):
+        #orientation(s) augments of x, see utils/symmetry.py. Only the requested orientations are computed
+        return orient_stack(x, augments)
@@ -0,0 +1,42 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+#low-res degradation operators for the T21 cubes:
+#stride: every factor-th cell, average: mean over factor^3 blocks, gaussian: periodic gaussian smoothing then stride,
+#noise: average plus gaussian noise of noise*mean(T21) per high-res cell. The defaults of the DataManager loaders reproduce
+#their original low-res: 'average' for generator_func (a 1/8 Conv3D, its GaussianNoise layer was called outside training
+#and added nothing) and 'stride' for data() and dataset() (every second cell)
+modes = ('stride', 'average', 'gaussian', 'noise')
+
+
+def degrade(x, factor=2, mode='stride', axes=(0,1,2), sigma=None, noise=0.05):
+    #vectorised over any batch/channel axes, axes are the three spatial axes of x
+    assert mode in modes, "mode must be one of {0}".format(modes)
+    assert all(x.shape[a] % factor == 0 for a in axes), "box size must be divisible by factor"
+    index = [slice(None)]*x.ndim
+    for a in axes:
+        index[a] = slice(None, None, factor)
+    index = tuple(index)
+
+    if mode == 'stride':
+        return x[index]
+    elif mode == 'gaussian':
+        sigma = factor/2 if sigma is None else sigma
+        sigmas = [sigma if a in axes else 0 for a in range(x.ndim)]
+        return gaussian_filter(np.asarray(x, dtype=np.float32), sigma=sigmas, mode='wrap')[index]
+
+    shape = []
+    for a,n in enumerate(x.shape):
+        shape += [n//factor, factor] if a in axes else [n]
+    block_axes = tuple(a + i + 1 for i,a in enumerate(sorted(axes)))
+    x_lr = np.asarray(x, dtype=np.float32).reshape(shape).mean(axis=block_axes)
+    if mode == 'noise':
+        x_lr = add_noise(x_lr, factor, axes=axes, noise=noise)
+    return x_lr
+
+
+def add_noise(x_lr, factor=2, axes=(0,1,2), noise=0.05):
+    #noise added to every high-res cell and then averaged over a factor^3 block has std/factor^1.5,
+    #so the noise can be added to a cached average-pooled cube. mean(T21) is the same for both resolutions
+    std = np.abs(noise * np.mean(x_lr, axis=axes, keepdims=True)) / factor**1.5
+    return (x_lr + std * np.random.normal(size=x_lr.shape)).astype(np.float32)
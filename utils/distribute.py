@@ -0,0 +1,48 @@
+import tensorflow as tf
+
+#tf.distribute setup for GAN.py. On one machine it can be tried with logical CPU devices (--strategy mirrored --cpu_replicas 2)
+#or with several localhost workers, one process per worker with its own TF_CONFIG (index 0 is the chief):
+#TF_CONFIG='{"cluster": {"worker": ["localhost:12345", "localhost:12346"]}, "task": {"type": "worker", "index": 0}}' python GAN.py --strategy multi_worker
+
+
+def make_strategy(name='none', cpu_replicas=1):
+    #'none': no strategy (returns None), 'mirrored': MirroredStrategy over the local GPUs, or over the logical CPU devices
+    #if there is no GPU, 'multi_worker': MultiWorkerMirroredStrategy over the cluster in TF_CONFIG.
+    #cpu_replicas > 1 splits the CPU into that many logical devices, which is only possible before tensorflow runs any op
+    assert name in ('none', 'mirrored', 'multi_worker'), "strategy must be 'none', 'mirrored' or 'multi_worker'"
+    if cpu_replicas > 1:
+        cpu = tf.config.list_physical_devices('CPU')[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()]*cpu_replicas)
+    if name == 'none':
+        return None
+    if name == 'mirrored':
+        devices = None if tf.config.list_physical_devices('GPU') else [device.name for device in tf.config.list_logical_devices('CPU')]
+        return tf.distribute.MirroredStrategy(devices=devices)
+    return tf.distribute.MultiWorkerMirroredStrategy()
+
+
+def is_chief(strategy):
+    #the process that writes the real checkpoints, metrics and validation plots: the chief, worker 0 or the only process
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or not resolver.cluster_spec().as_dict():
+        return True
+    if 'chief' in resolver.cluster_spec().as_dict():
+        return resolver.task_type == 'chief'
+    return resolver.task_type == 'worker' and resolver.task_id == 0
+
+
+def worker_dir(path, strategy):
+    #the other workers take part in every (collective) checkpoint save, but write it to a directory of their own
+    if is_chief(strategy):
+        return path
+    return path + "/workers/worker_{0}".format(strategy.cluster_resolver.task_id)
+
+
+def distribute_batches(strategy, dataset_fn, global_batch_size):
+    #dataset_fn(shards, shard_index) returns the unbatched samples of one input pipeline (one per worker), e.g.
+    #lambda shards, shard_index: Data.dataset(..., shards=shards, shard_index=shard_index). Each pipeline is batched to the
+    #per replica batch size. drop_remainder keeps the number of steps the same on every replica, the collectives of a step wait for all of them
+    def fn(context):
+        dataset = dataset_fn(context.num_input_pipelines, context.input_pipeline_id)
+        return dataset.batch(context.get_per_replica_batch_size(global_batch_size), drop_remainder=True).prefetch(tf.data.AUTOTUNE)
+    return strategy.distribute_datasets_from_function(fn)
@@ -0,0 +1,87 @@
+import json
+import os
+from utils.atomic import temp_name
+
+
+class FileManifest:
+    #(seed, redshift) -> file table for outputs/ and IC/. It is stored as JSON and the directories
+    #are only listed again when their mtime changes (a file was added, removed or renamed).
+    def __init__(self, path, manifest_file=None):
+        self.path = path
+        self.manifest_file = manifest_file if manifest_file is not None else path + '/cache/manifest.json'
+        self.T21 = {}
+        self.delta = {}
+        self.vbv = {}
+        self.loaded_mtimes = None
+        self.refresh()
+
+    def mtimes(self):
+        return {d: os.stat(self.path + '/' + d).st_mtime_ns for d in ('outputs', 'IC')}
+
+    def refresh(self):
+        mtimes = self.mtimes()
+        if mtimes == self.loaded_mtimes:
+            return
+        self.loaded_mtimes = mtimes
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                manifest = json.load(f)
+            if manifest['mtimes'] == mtimes:
+                self.T21 = {tuple(int(k) for k in key.split('_')): file for key, file in manifest['T21'].items()}
+                self.delta = {int(ID): file for ID, file in manifest['delta'].items()}
+                self.vbv = {int(ID): file for ID, file in manifest['vbv'].items()}
+                return
+        self.scan()
+        self.save(mtimes)
+
+    def scan(self):
+        self.T21, self.delta, self.vbv = {}, {}, {}
+        with os.scandir(self.path + '/outputs') as it:
+            for entry in it:
+                file = entry.name
+                if 'T21_cube' in file:
+                    z = int(file.split('_')[2])
+                    ID = int(file.split('_')[7])
+                    self.T21[(ID, z)] = file
+        with os.scandir(self.path + '/IC') as it:
+            for entry in it:
+                file = entry.name
+                if 'delta' in file:
+                    self.delta[int(file.split('delta')[1].split('.')[0])] = file
+                elif 'vbv' in file:
+                    self.vbv[int(file.split('vbv')[1].split('.')[0])] = file
+
+    def save(self, mtimes):
+        os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+        manifest = {'mtimes': mtimes,
+                    'T21': {'{0}_{1}'.format(ID, z): file for (ID, z), file in self.T21.items()},
+                    'delta': {str(ID): file for ID, file in self.delta.items()},
+                    'vbv': {str(ID): file for ID, file in self.vbv.items()},
+                    }
+        #several DataManagers or workers may scan and save at once, each through a temporary file of its own (see utils/atomic.py)
+        tmp_file = temp_name(self.manifest_file)
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, self.manifest_file)
+
+    def T21_file(self, ID, z):
+        return self.T21.get((int(ID), int(z)))
+
+    def delta_file(self, ID):
+        return self.delta.get(int(ID))
+
+    def vbv_file(self, ID):
+        return self.vbv.get(int(ID))
+
+    def missing(self, IC_seeds, redshifts):
+        #list of (field, seed, redshift) that have no file, redshift is None for the ICs
+        missing = []
+        for ID in IC_seeds:
+            if self.delta_file(ID) is None:
+                missing.append(('delta', ID, None))
+            if self.vbv_file(ID) is None:
+                missing.append(('vbv', ID, None))
+            for z in redshifts:
+                if self.T21_file(ID, z) is None:
+                    missing.append(('T21', ID, z))
+        return missing
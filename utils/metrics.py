@@ -0,0 +1,85 @@
+import json
+import numbers
+import os
+import queue
+import threading
+import time
+
+
+class MetricsLogger:
+    #append-only JSON lines log of the training metrics, one record per line: {"kind": "batch"|"epoch", "time": ..., ...}.
+    #log() only puts the record on a queue, a background thread writes it and flushes the file every flush_interval seconds,
+    #so logging never waits for the disk. Every line is a complete record: a crash loses at most the unflushed tail,
+    #and a half written last line is cut off when the log is opened again
+    def __init__(self, file, flush_interval=10.):
+        self.file = file
+        self.flush_interval = flush_interval
+        if os.path.exists(file):
+            with open(file, 'rb+') as f:
+                data = f.read()
+                if data and not data.endswith(b'\n'):
+                    f.truncate(data.rfind(b'\n') + 1)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, kind, **values):
+        #values can be python or numpy scalars
+        record = {'kind': kind, 'time': time.time()}
+        record.update({k: v if isinstance(v, str) else int(v) if isinstance(v, numbers.Integral) else float(v) for k,v in values.items()})
+        self.queue.put(record)
+
+    def run(self):
+        with open(self.file, 'a') as f:
+            last_flush = time.time()
+            unflushed = False
+            while True:
+                try:
+                    record = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    record = None
+                if isinstance(record, dict):
+                    f.write(json.dumps(record) + '\n')
+                    unflushed = True
+                if unflushed and (record in (None, 'flush', 'close') or time.time() - last_flush >= self.flush_interval):
+                    f.flush()
+                    os.fsync(f.fileno())
+                    last_flush = time.time()
+                    unflushed = False
+                if record is not None:
+                    self.queue.task_done()
+                if record == 'close':
+                    break
+
+    def flush(self):
+        #blocks until every record logged so far is on disk
+        self.queue.put('flush')
+        self.queue.join()
+
+    def close(self):
+        self.queue.put('close')
+        self.thread.join()
+
+
+def read_metrics(file, kind=None):
+    #records of a MetricsLogger file, optionally only those of one kind. A half written last line is skipped
+    records = []
+    if not os.path.exists(file):
+        return records
+    with open(file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if kind is None or record['kind'] == kind:
+                records.append(record)
+    return records
+
+
+def epoch_history(file):
+    #(generator_losses_epoch, critic_losses_epoch, gradient_penalty_epoch) as stored in losses.pkl before.
+    #An epoch trained again after resuming from an older checkpoint is logged twice, the last record is used
+    epochs = {r['epoch']: r for r in read_metrics(file, kind='epoch')}
+    epochs = [epochs[e] for e in sorted(epochs)]
+    return [r['generator_loss'] for r in epochs], [r['critic_loss'] for r in epochs], [r['gradient_penalty'] for r in epochs]
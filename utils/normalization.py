@@ -0,0 +1,28 @@
+import tensorflow as tf
+
+
+def standardize(data, data_stats):
+    #mean and var across xyz of data_stats with shape=(batch,x,y,z,channels), pure tf so it can run inside tf.data or a tf.function
+    mean, var = tf.nn.moments(data_stats, axes=[1,2,3], keepdims=True)
+    return standardize_with(data, mean, var)
+
+
+def standardize_with(data, mean, var):
+    #mean and var must broadcast against data. Empty cubes (mean and var both zero) get mean 0 and var 1
+    empty = tf.logical_and(tf.equal(mean, 0), tf.equal(var, 0))
+    mean = tf.where(empty, tf.zeros_like(mean), mean)
+    var = tf.where(empty, tf.ones_like(var), var)
+    return (data - mean) / tf.sqrt(var)
+
+
+#redshifts 6-27 of the simulations map to [-1,1]. Fixed rather than fitted to the training redshifts, so a checkpoint
+#means the same thing whichever redshifts it was trained on
+redshift_center = 16.5
+redshift_scale = 10.5
+
+
+def append_redshift(vbv, z):
+    #vbv with shape=(...,channels) and a constant channel of the scaled redshift z appended, the conditioning input of a
+    #multi-redshift Generator/Critic (vbv_shape[-1]=2). z is a scalar or broadcasts against vbv, e.g. shape=(batch,1,1,1,1)
+    condition = tf.ones_like(vbv[...,:1]) * (tf.cast(z, vbv.dtype) - redshift_center) / redshift_scale
+    return tf.concat([vbv, condition], axis=-1)
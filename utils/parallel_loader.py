@@ -0,0 +1,146 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from scipy.io import loadmat
+from utils.cube_cache import CubeCache
+from utils.cube_store import CubeStore
+
+#The workers are separate interpreters (python -m utils.parallel_loader, as utils/validation.py does), not forked or
+#multiprocessing-spawned children: the training process already runs tensorflow's threads, so a fork can inherit a lock
+#held by one of them and deadlock, and spawn/forkserver re-run the training script (GAN.py has no __main__ guard) in every
+#worker. This module only imports numpy, scipy and h5py, the workers never load tensorflow
+
+
+def load_to_shared_memory(path, cache_dtype, cubes, store=None):
+    #runs in a worker process: decodes the cubes [(field, file, ID, z), ...] of one sample into a single
+    #(x,y,z,len(cubes)) float32 shared memory block and returns its name and shape. cache_dtype=None reads the .mat files,
+    #or the store (a utils/cube_store.py CubeStore) if one is given
+    cube_cache = CubeCache(path, dtype=cache_dtype, store=store) if cache_dtype is not None else None
+    shm = None
+    for c,(field, file, ID, z) in enumerate(cubes):
+        if cube_cache is not None:
+            cube = cube_cache.load(field, file, ID, z)
+        elif store is not None:
+            cube = store.read(field, ID, z)
+        else:
+            cube = loadmat(path + '/' + CubeCache.source_dirs[field] + '/' + file)[CubeCache.mat_keys[field]]
+        if shm is None:
+            shape = (*cube.shape, len(cubes))
+            shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*4)
+            out = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        out[...,c] = cube
+    del out
+    shm.close()
+    #the block is owned (and unlinked) by the process that consumes it, not by this worker's resource tracker
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm.name, shape
+
+
+class ParallelCubeLoader:
+    #decodes the cubes of a DataManager in a pool of worker processes, the arrays are handed back through shared memory.
+    #generate() is meant to be used with tf.data.Dataset.from_generator inside an interleave, so that several samples
+    #are in flight while the training step runs (see DataManager.dataset(workers=...)).
+    #Every worker has a thread here that hands it one job at a time (a JSON line on its stdin) and resolves the job's
+    #future with the worker's reply (a JSON line on its stdout)
+    def __init__(self, manager, workers=None):
+        self.manager = manager
+        self.workers = workers if workers is not None else max(os.cpu_count()-1, 1)
+        self.jobs = queue.Queue()
+        command = [sys.executable, '-m', 'utils.parallel_loader', '--path', manager.path]
+        if manager.cache is not None:
+            command += ['--cache_dtype', manager.cache.dtype.name]
+        if manager.store is not None:
+            command += ['--store', manager.store.file]
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.processes = [subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, cwd=cwd) for _ in range(self.workers)]
+        self.threads = [threading.Thread(target=self.serve, args=(process,), daemon=True) for process in self.processes]
+        for thread in self.threads:
+            thread.start()
+
+    def serve(self, process):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, cubes = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                process.stdin.write(json.dumps(cubes) + '\n')
+                process.stdin.flush()
+                reply = process.stdout.readline()
+                assert reply, "loader worker exited with code {0}".format(process.poll())
+                reply = json.loads(reply)
+                assert 'error' not in reply, "loader worker failed: {0}".format(reply.get('error'))
+                future.set_result((reply['name'], tuple(reply['shape'])))
+            except (AssertionError, OSError, ValueError) as e:
+                future.set_exception(e)
+
+    def cubes(self, i, j=-1):
+        #redshift index j, all redshifts for j=-1
+        m = self.manager
+        ID = int(m.IC_seeds[i])
+        cubes = [('T21', m.T21_files[i,j], ID, int(m.redshifts[j])) for j in m.redshift_indices(j)]
+        return cubes + [('delta', m.delta_files[i], ID, None), ('vbv', m.vbv_files[i], ID, None)]
+
+    def submit(self, i, j=-1):
+        future = concurrent.futures.Future()
+        self.jobs.put((future, self.cubes(int(i), int(j))))
+        return future
+
+    def generate(self, i, j=-1):
+        #yields (T21, delta, vbv) of IC seed index i (and redshift index j) as views of the shared memory block, which is released once the consumer has copied them
+        name, shape = self.submit(i, j).result()
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            sample = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+            yield sample[...,:-2], sample[...,-2:-1], sample[...,-1:]
+            del sample
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        #cancels the jobs that haven't started, waits for the running ones and stops the workers
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job[0].cancel()
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        for process in self.processes:
+            process.stdin.close()
+            process.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Loader worker, reads [[field, file, ID, z], ...] jobs as JSON lines from stdin")
+    parser.add_argument('--path', type=str, required=True, help='Directory containing outputs/ and IC/')
+    parser.add_argument('--cache_dtype', type=str, default=None, help='Read through the .npy cache of this dtype')
+    parser.add_argument('--store', type=str, default=None, help='HDF5 cube store to read from')
+    args = parser.parse_args()
+
+    #replies go to a copy of stdout, anything else printed in the worker goes to stderr and can't corrupt them
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    store = CubeStore(args.store) if args.store is not None else None
+    for line in sys.stdin:
+        try:
+            name, shape = load_to_shared_memory(args.path, args.cache_dtype, json.loads(line), store)
+            reply = {'name': name, 'shape': list(shape)}
+        except Exception as e:
+            reply = {'error': repr(e)}
+        replies.write(json.dumps(reply) + '\n')
+        replies.flush()
@@ -0,0 +1,93 @@
+import contextlib
+import os
+import resource
+import time
+import tensorflow as tf
+
+
+class Profiler:
+    #Named stage timers and counters for the training loop, summarised into the metrics log once per epoch.
+    #When disabled, timer() hands out one shared no-op context manager and count()/step() return straight away,
+    #so the instrumented loop costs the same as an uninstrumented one.
+    #trace_steps=(start, stop) also captures a tf.profiler trace (TensorBoard profile plugin) of those train steps into trace_dir
+    def __init__(self, enabled=False, trace_dir=None, trace_steps=None):
+        self.enabled = enabled
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps
+        self.tracing = False
+        self.null_timer = contextlib.nullcontext()
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.counts = {}
+        self.peak_rss = 0
+
+    @contextlib.contextmanager
+    def _timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.) + time.perf_counter() - start
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def timer(self, name):
+        #with profiler.timer('critic_step'): ... adds the elapsed time to the stage. Results must be synced
+        #(e.g. .numpy()) inside the block, or only the dispatch of asynchronous ops is timed
+        if not self.enabled:
+            return self.null_timer
+        return self._timer(name)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def step(self, step):
+        #called once per train step: starts/stops the trace window and samples the memory
+        if not self.enabled:
+            return
+        if self.trace_steps is not None:
+            if (not self.tracing) and (self.trace_steps[0] <= step < self.trace_steps[1]):
+                tf.profiler.experimental.start(self.trace_dir)
+                self.tracing = True
+            elif self.tracing and (step >= self.trace_steps[1]):
+                tf.profiler.experimental.stop()
+                self.tracing = False
+        self.peak_rss = max(self.peak_rss, rss())
+
+    def summary(self, reset=True):
+        #{stage}_s (total seconds), {stage}_n (calls) and memory in MB, for MetricsLogger.log('profile', **summary)
+        summary = {}
+        for name in self.counts:
+            if name in self.totals:
+                summary[name + '_s'] = self.totals[name]
+            summary[name + '_n'] = self.counts[name]
+        summary['rss_mb'] = rss() / 2**20
+        summary['peak_rss_mb'] = max(self.peak_rss, rss()) / 2**20
+        summary.update(tensor_memory())
+        if reset:
+            self.reset()
+        return summary
+
+    def close(self):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+
+
+def rss():
+    #current resident set size in bytes (linux), the process peak elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def tensor_memory():
+    #current and peak tensor memory of the first GPU in MB, the CPU allocator doesn't report it
+    if not tf.config.list_physical_devices('GPU'):
+        return {}
+    info = tf.config.experimental.get_memory_info('GPU:0')
+    return {'gpu_current_mb': info['current'] / 2**20, 'gpu_peak_mb': info['peak'] / 2**20}
@@ -0,0 +1,76 @@
+import numpy as np
+import tensorflow as tf
+
+#(transpose, reversed axes) of the 24 cube orientations, in the order used by DataManager.augment_data. 23 is the unaltered box
+orientations = [((0,1,2), (0,1)), ((0,1,2), (0,2)), ((0,1,2), (1,2)),
+                ((1,0,2), (0,)), ((1,0,2), (0,2)), ((1,0,2), (1,)), ((1,0,2), (1,2)),
+                ((2,1,0), (0,)), ((2,1,0), (0,1)), ((2,1,0), (2,)), ((2,1,0), (1,2)),
+                ((0,2,1), (1,)), ((0,2,1), (0,1)), ((0,2,1), (2,)), ((0,2,1), (0,2)),
+                ((1,2,0), (0,1)), ((1,2,0), (1,2)), ((1,2,0), (0,2)), ((1,2,0), (0,1,2)),
+                ((2,0,1), (0,1)), ((2,0,1), (0,2)), ((2,0,1), (1,2)), ((2,0,1), (0,1,2)),
+                ((0,1,2), ()),
+                ]
+
+
+def orient(x, k, axes=(0,1,2)):
+    #zero-copy view of x in orientation k (transpose + negative strides).
+    #axes are the three spatial axes of x, e.g. axes=(1,2,3) for (batch,x,y,z,channels) arrays
+    perm, flips = orientations[int(k)]
+    order = list(range(x.ndim))
+    for a,p in zip(axes, perm):
+        order[a] = axes[p]
+    index = [slice(None)]*x.ndim
+    for f in flips:
+        index[axes[f]] = slice(None, None, -1)
+    return np.transpose(x, order)[tuple(index)]
+
+
+def stride_offsets(k, shape, factor):
+    #orient(x,k)[::factor,::factor,::factor] holds the same cells as x[o0::factor,o1::factor,o2::factor], returns (o0,o1,o2)
+    perm, flips = orientations[int(k)]
+    offsets = [0, 0, 0]
+    for a in flips:
+        offsets[perm[a]] = (shape[perm[a]]-1) % factor
+    return tuple(offsets)
+
+
+def orient_stack(x, ks, axes=(0,1,2)):
+    #only the requested orientations are computed: a view for a single k, a (len(ks),*x.shape) copy for a list
+    if np.ndim(ks) == 0:
+        return orient(x, ks, axes)
+    return np.stack([orient(x, k, axes) for k in ks])
+
+
+def orient_tf(x, k, axes=(0,1,2)):
+    #in-graph version of orient, k can be a tensor. Only the branch for k is executed
+    def branch(perm, flips):
+        order = list(range(x.shape.rank))
+        for a,p in zip(axes, perm):
+            order[a] = axes[p]
+        return lambda: tf.reverse(tf.transpose(x, order), axis=[axes[f] for f in flips])
+    return tf.switch_case(tf.cast(k, tf.int32), [branch(perm, flips) for perm,flips in orientations])
+
+
+def periodic_crop_tf(x, offset, size, axes=(0,1,2)):
+    #size^3 sub-volume of x starting at offset (3 ints, can be a tensor), wrapped around the periodic box.
+    #Gathered one axis at a time, so only the first gather reads the whole cube
+    for a, axis in enumerate(axes):
+        x = tf.gather(x, (offset[a] + tf.range(size)) % tf.shape(x)[axis], axis=axis)
+    return x
+
+
+def periodic_crop(x, offset, size, axes=(0,1,2)):
+    #numpy version of periodic_crop_tf, x can be a memmap (only the rows of the crop are read)
+    for a, axis in enumerate(axes):
+        x = np.take(x, (int(offset[a]) + np.arange(size)) % x.shape[axis], axis=axis)
+    return x
+
+
+def stored_offset(k, offset, size, n):
+    #corner in the unaltered box of the size^3 patch at offset in the box oriented with k (box size n):
+    #orient(periodic_crop(x, stored_offset(k, offset, size, n), size), k) == periodic_crop(orient(x, k), offset, size)
+    perm, flips = orientations[int(k)]
+    stored = [0, 0, 0]
+    for a in range(3):
+        stored[perm[a]] = (n - int(offset[a]) - size) % n if a in flips else int(offset[a])
+    return stored
@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+from utils.atomic import temp_name
+
+#Validation plots off the training critical path. AsyncValidation (used by GAN.py) starts this module as a separate
+#process (python -m utils.validation), on the CPU by default so it doesn't compete for the GPU. It loads and standardises
+#the validation cubes once, then for every job it reads a snapshot of the generator weights, runs the generator and
+#renders the loss history and validation figure. A separate interpreter rather than multiprocessing: GAN.py has no
+#__main__ guard (spawn would re-run it) and the training process has already initialised tensorflow (fork isn't safe)
+
+
+class AsyncValidation:
+    def __init__(self, model_path, data_path, IC_seeds, redshift, figure, title, sigmas=3, plot_slice=False, every=1, device='',
+                 redshift_conditioning=False, store=None):
+        #every: validate every n-th epoch, device: CUDA_VISIBLE_DEVICES of the worker ('' runs it on the CPU),
+        #redshift_conditioning: the generator takes the redshift as a second vbv channel, store: HDF5 cube store to read from
+        self.model_path = model_path
+        self.every = every
+        self.snapshot_dir = model_path + "/validation"
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=device)
+        command = [sys.executable, '-m', 'utils.validation', '--path', data_path, '--model_path', model_path,
+                   '--IC_seeds', *[str(ID) for ID in IC_seeds], '--redshift', str(redshift), '--figure', figure,
+                   '--title', title, '--sigmas', str(sigmas)] + (['--plot_slice'] if plot_slice else []) + \
+                  (['--redshift_conditioning'] if redshift_conditioning else []) + (['--store', store] if store is not None else [])
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, text=True, env=env,
+                                        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    def submit(self, epoch, generator):
+        #snapshots the generator weights (the worker deletes the file once it's done) and queues a validation of them
+        if epoch % self.every != 0:
+            return
+        assert self.process.poll() is None, "validation worker exited with code {0}".format(self.process.returncode)
+        weights_file = self.snapshot_dir + "/generator_epoch_{0}.npz".format(epoch)
+        tmp_file = temp_name(weights_file)
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, *generator.model.get_weights())
+        os.replace(tmp_file, weights_file)
+        self.process.stdin.write(json.dumps({'epoch': epoch, 'weights': weights_file}) + '\n')
+        self.process.stdin.flush()
+
+    def close(self):
+        #waits for the queued validations to finish
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def plot_and_save(generator, validation_data, IC_seeds, losses, figure, title, sigmas, plot_slice=True):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
+
+    generator_losses_epoch, critic_losses_epoch, gradient_penalty_epoch = losses
+    T21_standardized, T21_lr_standardized, delta, vbv_standardized = validation_data
+
+    fig = plt.figure(tight_layout=True, figsize=(20,10))
+    gs = gridspec.GridSpec(len(IC_seeds)+1, 6, figure=fig)
+    ax_loss = fig.add_subplot(gs[0,:])
+
+    #loss row
+    ax_loss.plot(range(len(generator_losses_epoch)), generator_losses_epoch, label="generator")
+    ax_loss.plot(range(len(critic_losses_epoch)), critic_losses_epoch, label="critic")
+    ax_loss.plot(range(len(gradient_penalty_epoch)), gradient_penalty_epoch, label="gradient penalty")
+    ax_loss.set_title(title)
+    ax_loss.set_xlabel("Epoch")
+    ax_loss.set_ylabel("Loss")
+    ax_loss.legend()
+
+    generated_boxes = generator(T21_lr_standardized, delta, vbv_standardized).numpy()
+
+    for i,IC in enumerate(IC_seeds):
+        # Plot histograms
+        ax_hist = fig.add_subplot(gs[i+1,0])
+        ax_hist.hist(generated_boxes[i, :, :, :, 0].flatten(), bins=100, alpha=0.5, label="generated", density=True)
+        ax_hist.hist(T21_standardized[i, :, :, :, 0].numpy().flatten(), bins=100, alpha=0.5, label="real", density=True)
+        ax_hist.set_xlabel("Standardized T21")
+        ax_hist.set_title("Histograms of standardized data")
+        ax_hist.legend()
+
+        # Plot real and generated data
+        T21_std = np.std(T21_standardized[i, :, :, :, 0].numpy().flatten())
+        ax_gen = fig.add_subplot(gs[i+1,1])
+        ax_gen.imshow(generated_boxes[i, :, :, 64, 0], vmin=-sigmas*T21_std, vmax=sigmas*T21_std)
+        ax_gen.set_title("Generated")
+        ax_real = fig.add_subplot(gs[i+1,2])
+        ax_real.imshow(T21_standardized[i, :, :, 64, 0], vmin=-sigmas*T21_std, vmax=sigmas*T21_std)
+        ax_real.set_title("Real")
+        ax_real_lr = fig.add_subplot(gs[i+1,3])
+        ax_real_lr.imshow(T21_lr_standardized[i, :, :, 32, 0], vmin=-sigmas*T21_std, vmax=sigmas*T21_std)
+        ax_real_lr.set_title("Real lr")
+
+        if plot_slice:
+            ax_delta = fig.add_subplot(gs[i+1,4])
+            delta_std = np.std(delta[i, :, :, :, 0].numpy().flatten())
+            ax_delta.imshow(delta[i, :, :, 64, 0], vmin=-sigmas*delta_std, vmax=sigmas*delta_std)
+            ax_delta.set_title("Delta IC ID={0}".format(IC))
+            ax_vbv = fig.add_subplot(gs[i+1,5])
+            vbv_std = np.std(vbv_standardized[i, :, :, :, 0].numpy().flatten())
+            ax_vbv.imshow(vbv_standardized[i, :, :, 64, 0], vmin=-sigmas*vbv_std, vmax=sigmas*vbv_std)
+            ax_vbv.set_title("Vbv IC ID={0}".format(IC))
+        else: #histogram delta and vbv_standardised
+            ax_delta = fig.add_subplot(gs[i+1,4])
+            ax_delta.hist(delta[i, :, :, :, 0].numpy().flatten(), bins=100, alpha=0.5, label="delta", density=True)
+            ax_delta.set_title("Histogram delta IC ID={0}".format(IC))
+            ax_delta.legend()
+            ax_vbv = fig.add_subplot(gs[i+1,5])
+            ax_vbv.hist(vbv_standardized[i, :, :, :, 0].numpy().flatten(), bins=100, alpha=0.5, label="vbv", density=True)
+            ax_vbv.set_title("Histogram vbv IC ID={0}".format(IC))
+            ax_vbv.legend()
+
+    # Save figure, renamed into place so a half drawn png is never left behind
+    tmp_file = temp_name(figure, '.tmp.png')
+    plt.savefig(tmp_file)
+    plt.close(fig)
+    os.replace(tmp_file, figure)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validation worker, reads {'epoch', 'weights'} jobs as JSON lines from stdin")
+    parser.add_argument('--path', type=str, required=True, help='Directory containing outputs/ and IC/')
+    parser.add_argument('--model_path', type=str, required=True, help='Model directory with metrics.jsonl')
+    parser.add_argument('--IC_seeds', type=int, nargs='+', required=True)
+    parser.add_argument('--redshift', type=int, required=True)
+    parser.add_argument('--figure', type=str, required=True)
+    parser.add_argument('--title', type=str, default='')
+    parser.add_argument('--sigmas', type=float, default=3)
+    parser.add_argument('--plot_slice', action='store_true')
+    parser.add_argument('--redshift_conditioning', action='store_true')
+    parser.add_argument('--store', type=str, default=None)
+    args = parser.parse_args()
+
+    from models.wgan import Generator
+    from utils.data_manager import DataManager
+    from utils.metrics import epoch_history
+    from utils.normalization import standardize, append_redshift
+
+    #validation cubes are loaded and standardised once for the whole run
+    Data_validation = DataManager(args.path, redshifts=[args.redshift,], IC_seeds=args.IC_seeds, store=args.store)
+    T21, delta, vbv, T21_lr = Data_validation.data(augment=False, augments=9, low_res=True)
+    vbv_standardized = standardize(vbv, vbv)
+    if args.redshift_conditioning:
+        vbv_standardized = append_redshift(vbv_standardized, args.redshift)
+    validation_data = (standardize(T21, T21_lr), standardize(T21_lr, T21_lr), delta, vbv_standardized)
+    generator = Generator(vbv_shape=(1,128,128,128,1+args.redshift_conditioning))
+    print("Validation worker ready", flush=True)
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        with np.load(job['weights']) as weights:
+            generator.model.set_weights([weights['arr_{0}'.format(n)] for n in range(len(weights.files))])
+        os.remove(job['weights'])
+        plot_and_save(generator, validation_data, args.IC_seeds, epoch_history(args.model_path + "/metrics.jsonl"),
+                      args.figure, args.title, args.sigmas, plot_slice=args.plot_slice)
+        print("Validation of epoch {0} saved to {1}".format(job['epoch'] + 1, args.figure), flush=True)